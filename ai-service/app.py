@@ -5,10 +5,12 @@ Classly AI Service
 This service can run as:
 1. CLI tool: python ai_service.py [classroom_id]
 2. HTTP server: python ai_service.py --server
+3. Bulk run over all classrooms via the OpenAI Batch API: python ai_service.py --batch
 
 Features:
 - Generates cumulative study guides organized by units
 - Only processes NEW uploads (saves API credits)
+- Reuses the stored study guide when uploads are unchanged (same upload IDs)
 - Analyzes chat for confusion patterns (aggregated, anonymous)
 - Supports both Google Gemini and OpenAI GPT
 
@@ -20,19 +22,52 @@ PRIVACY ARCHITECTURE:
 """
 
 import os
-import sys
-import json
-from datetime import datetime
-from typing import List, Dict, Optional
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# gevent workers need sockets/ssl/threading patched before anything else
+# imports them (the LLM SDKs and Supabase client all open sockets).
+if os.getenv('AI_SERVICE_WORKER_CLASS', 'gthread') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import re
+import sys
+import json
+import base64
+import hashlib
+import time
+import uuid
+import queue
+import threading
+import traceback
+from contextlib import nullcontext
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, List, Dict, Optional, Tuple
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+
+# orjson is optional: faster response serialization when installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Supabase configuration
 SUPABASE_URL = os.getenv('SUPABASE_URL')
 SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_KEY')
 
+# Supabase HTTP connection pool
+SUPABASE_MAX_CONNECTIONS = int(os.getenv('SUPABASE_MAX_CONNECTIONS', '60'))
+SUPABASE_MAX_KEEPALIVE = int(os.getenv('SUPABASE_MAX_KEEPALIVE', '40'))
+SUPABASE_KEEPALIVE_EXPIRY = float(os.getenv('SUPABASE_KEEPALIVE_EXPIRY', '30'))
+# Seconds before a Supabase query is abandoned
+SUPABASE_TIMEOUT = float(os.getenv('SUPABASE_TIMEOUT', '30'))
+
 # AI Provider configuration
 # Options: 'gemini' or 'openai'
 AI_PROVIDER = os.getenv('AI_PROVIDER', 'gemini').lower()
@@ -45,8 +80,77 @@ GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
 
+# Optional second provider used while AI_PROVIDER is failing (needs its own API key).
+# After AI_PROVIDER_FAILURE_THRESHOLD consecutive failures a provider is skipped
+# for AI_PROVIDER_COOLDOWN seconds before it is tried again.
+AI_FALLBACK_PROVIDER = os.getenv('AI_FALLBACK_PROVIDER', '').lower() or None
+PROVIDER_FAILURE_THRESHOLD = int(os.getenv('AI_PROVIDER_FAILURE_THRESHOLD', '3'))
+PROVIDER_COOLDOWN = float(os.getenv('AI_PROVIDER_COOLDOWN', '60'))
+
+# Study guide map-reduce configuration
+# Notes longer than STUDY_GUIDE_MAP_REDUCE_TOKENS are condensed in shards of
+# STUDY_GUIDE_SHARD_SIZE uploads before the final study guide prompt.
+STUDY_GUIDE_MAP_REDUCE_TOKENS = int(os.getenv('STUDY_GUIDE_MAP_REDUCE_TOKENS', '8000'))
+STUDY_GUIDE_SHARD_SIZE = int(os.getenv('STUDY_GUIDE_SHARD_SIZE', '5'))
+# Token budget for the notes in the final study guide prompt, so the prompt
+# plus a full-length guide fits a 128k-token context window
+STUDY_GUIDE_MAX_INPUT_TOKENS = int(os.getenv('STUDY_GUIDE_MAX_INPUT_TOKENS', '100000'))
+# Study guides may be up to twice as long as their prompt, but never capped
+# below STUDY_GUIDE_MIN_OUTPUT_TOKENS
+STUDY_GUIDE_MIN_OUTPUT_TOKENS = 4096
+
+# Batch processing: classrooms processed in parallel by process_all_classrooms
+MAX_CONCURRENT_CLASSROOMS = int(os.getenv('AI_MAX_CONCURRENT_CLASSROOMS', '4'))
+
+# Seconds before a single LLM request is abandoned, so a stalled provider
+# call frees its server thread/greenlet instead of holding it until the
+# gunicorn timeout kills the whole worker.
+LLM_TIMEOUT = float(os.getenv('AI_LLM_TIMEOUT', '120'))
+
+# Max LLM requests started per second, and prompt+output tokens per minute,
+# by this process (0 = unlimited). Set them under the provider's rate limits
+# so parallel classrooms are paced instead of bouncing off 429s.
+LLM_REQUESTS_PER_SECOND = float(os.getenv('AI_LLM_REQUESTS_PER_SECOND', '0'))
+LLM_TOKENS_PER_MINUTE = float(os.getenv('AI_LLM_TOKENS_PER_MINUTE', '0'))
+LLM_OUTPUT_TOKEN_ESTIMATE = 1500  # Tokens budgeted for each response without its own cap
+LLM_MAX_OUTPUT_TOKENS = 16384  # Provider-side ceiling on generated tokens
+# Rate-limited (429) calls are retried after the provider's Retry-After
+# (or an exponential backoff); every thread pauses for that long
+LLM_RATE_LIMIT_RETRIES = int(os.getenv('AI_LLM_RATE_LIMIT_RETRIES', '3'))
+LLM_RATE_LIMIT_BACKOFF = 5.0
+
+# Max LLM requests in flight at once in this process (0 = unlimited). Bulk
+# runs fan out over classrooms, their two insight calls and note shards;
+# this caps the total no matter how the thread pools multiply.
+LLM_MAX_CONCURRENT_CALLS = int(os.getenv('AI_LLM_MAX_CONCURRENT_CALLS', '16'))
+
+# Seconds an idle connection to the LLM provider is kept open for reuse
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('AI_LLM_KEEPALIVE_EXPIRY', '60'))
+
+# Redis (optional): shared background job queue and LLM response cache
+REDIS_URL = os.getenv('REDIS_URL')
+# Seconds a cached LLM response (confusion analysis, note shard summary) is
+# reused for an identical prompt. Without Redis the cache is kept in the
+# SQLite file LLM_CACHE_PATH when set (survives restarts and CLI runs),
+# otherwise in process, limited to LLM_LOCAL_CACHE_SIZE entries.
+LLM_CACHE_TTL = int(os.getenv('AI_LLM_CACHE_TTL', '86400'))
+LLM_CACHE_PATH = os.getenv('AI_LLM_CACHE_PATH')
+LLM_LOCAL_CACHE_SIZE = 256
+
 # Server configuration
 SERVER_PORT = int(os.getenv('AI_SERVICE_PORT', '5000'))
+# Production server (gunicorn) settings: each worker process serves
+# SERVER_THREADS concurrent requests, so slow LLM calls don't block others.
+# With SERVER_WORKER_CLASS='gevent' each worker instead multiplexes up to
+# SERVER_WORKER_CONNECTIONS requests on greenlets (requires `gevent`).
+SERVER_WORKERS = int(os.getenv('AI_SERVICE_WORKERS', '2'))
+SERVER_WORKER_CLASS = os.getenv('AI_SERVICE_WORKER_CLASS', 'gthread')
+SERVER_THREADS = int(os.getenv('AI_SERVICE_THREADS', '8'))
+SERVER_WORKER_CONNECTIONS = int(os.getenv('AI_SERVICE_WORKER_CONNECTIONS', '1000'))
+SERVER_TIMEOUT = int(os.getenv('AI_SERVICE_TIMEOUT', '180'))
+# Seconds an idle client connection is kept open for its next request
+# (gunicorn's default of 2s makes callers polling /status reconnect each time)
+SERVER_KEEPALIVE = int(os.getenv('AI_SERVICE_KEEPALIVE', '30'))
 
 def check_env():
     """Check for required environment variables."""
@@ -69,6 +173,15 @@ def check_env():
         print(f"Error: Invalid AI_PROVIDER '{AI_PROVIDER}'. Must be 'gemini' or 'openai'")
         return False
     
+    if AI_FALLBACK_PROVIDER and AI_FALLBACK_PROVIDER != AI_PROVIDER:
+        if AI_FALLBACK_PROVIDER not in ('gemini', 'openai'):
+            print(f"Error: Invalid AI_FALLBACK_PROVIDER '{AI_FALLBACK_PROVIDER}'. Must be 'gemini' or 'openai'")
+            return False
+        fallback_key = GEMINI_API_KEY if AI_FALLBACK_PROVIDER == 'gemini' else OPENAI_API_KEY
+        if not fallback_key:
+            print(f"Error: {AI_FALLBACK_PROVIDER.upper()}_API_KEY must be set when AI_FALLBACK_PROVIDER={AI_FALLBACK_PROVIDER}")
+            return False
+    
     return True
 
 def get_ai_provider_info() -> str:
@@ -79,61 +192,449 @@ def get_ai_provider_info() -> str:
         return f"OpenAI ({OPENAI_MODEL})"
     return "Unknown"
 
+def utc_now_iso() -> str:
+    """Current time as a timezone-aware UTC ISO-8601 string."""
+    return datetime.now(timezone.utc).isoformat()
+
+
 # Initialize Supabase client (lazy)
+# The client shares one pooled httpx connection pool with keep-alive, so
+# repeated queries reuse warm TCP/TLS connections instead of reconnecting.
+# Guards lazy client creation so concurrent first calls share one client
+_clients_lock = threading.RLock()
+
 _supabase = None
 def get_supabase():
     global _supabase
     if _supabase is None:
-        from supabase import create_client
-        _supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+        with _clients_lock:
+            if _supabase is None:
+                import httpx
+                from supabase import create_client, ClientOptions
+
+                # With the optional `h2` package, concurrent queries share one
+                # HTTP/2 connection instead of each holding its own TLS connection
+                try:
+                    import h2  # noqa: F401
+                    http2 = True
+                except ImportError:
+                    http2 = False
+
+                http_client = httpx.Client(timeout=SUPABASE_TIMEOUT, http2=http2, limits=httpx.Limits(
+                    max_connections=SUPABASE_MAX_CONNECTIONS,
+                    max_keepalive_connections=SUPABASE_MAX_KEEPALIVE,
+                    keepalive_expiry=SUPABASE_KEEPALIVE_EXPIRY,
+                ))
+                try:
+                    options = ClientOptions(httpx_client=http_client, postgrest_client_timeout=SUPABASE_TIMEOUT)
+                except TypeError:
+                    # Older supabase-py releases can't take a custom client; keep their default pool
+                    http_client.close()
+                    options = ClientOptions(postgrest_client_timeout=SUPABASE_TIMEOUT)
+                _supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY, options=options)
     return _supabase
 
-# Embeddings removed; clustering disabled — no heavy ML dependency required.
+
+_redis = None
+def get_redis():
+    """Get the shared Redis client, or None when REDIS_URL is not set."""
+    global _redis
+    if _redis is None and REDIS_URL:
+        with _clients_lock:
+            if _redis is None:
+                from redis import Redis
+                # Connections come from the client's pool and are reused across threads
+                _redis = Redis.from_url(REDIS_URL)
+    return _redis
+
+
+# Query settings
+UPLOAD_COLUMNS = 'id, title, content, file_type, created_at'
+# Image uploads are base64 data URLs (often MBs each). They are listed without
+# their content and only downloaded when a study guide is actually generated;
+# uploads are never edited, so the ID identifies the image for the cache.
+IMAGE_UPLOAD_COLUMNS = 'id, title, file_type, created_at'
+IMAGE_FILE_TYPE_PATTERN = 'image/*'
+IMAGE_CONTENT_BATCH_SIZE = 10
+# Pages hold text notes and image metadata only (image data is loaded
+# separately), so they can be large; PostgREST caps responses at 1000 rows.
+UPLOADS_PAGE_SIZE = 500
+MESSAGE_WINDOW = 100  # Most recent distinct messages used for confusion analysis
+MESSAGE_SCAN_WINDOW = 500  # Recent messages scanned to find MESSAGE_WINDOW distinct ones
+MESSAGE_DUPLICATE_SIMILARITY = 0.8  # Jaccard similarity above which messages count as repeats
+CONFUSION_MAX_INPUT_TOKENS = 1000  # Token budget for the messages in the confusion prompt
+CONFUSION_MAX_OUTPUT_TOKENS = 512  # The prompt asks for under 200 words
+
+
+def _fetch_upload_pages(build_query) -> List[Dict]:
+    """Read every row of an uploads query in pages of UPLOADS_PAGE_SIZE."""
+    rows = []
+    offset = 0
+    while True:
+        response = build_query().range(offset, offset + UPLOADS_PAGE_SIZE - 1).execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < UPLOADS_PAGE_SIZE:
+            return rows
+        offset += UPLOADS_PAGE_SIZE
+
+
+def fetch_upload_ids(classroom_id: str) -> List[str]:
+    """Fetch just the IDs of a classroom's uploads."""
+    supabase = get_supabase()
+    rows = _fetch_upload_pages(
+        lambda: supabase.table('uploads').select('id').eq('classroom_id', classroom_id).order('id')
+    )
+    return [row['id'] for row in rows]
 
 
 def fetch_uploads(classroom_id: str) -> List[Dict]:
-    """Fetch all uploads for a classroom."""
+    """
+    Fetch all uploads for a classroom, oldest first.
+    
+    Only the columns the pipeline uses are selected, and rows are read in
+    pages of UPLOADS_PAGE_SIZE so large classrooms never need one huge response.
+    Image uploads come back without 'content'; see `load_image_contents`.
+    """
+    supabase = get_supabase()
+    
+    def text_uploads():
+        return (
+            supabase.table('uploads')
+            .select(UPLOAD_COLUMNS)
+            .eq('classroom_id', classroom_id)
+            .or_(f'file_type.is.null,file_type.not.like.{IMAGE_FILE_TYPE_PATTERN}')
+            .order('created_at').order('id')
+        )
+    
+    def image_uploads():
+        return (
+            supabase.table('uploads')
+            .select(IMAGE_UPLOAD_COLUMNS)
+            .eq('classroom_id', classroom_id)
+            .like('file_type', IMAGE_FILE_TYPE_PATTERN)
+            .order('created_at').order('id')
+        )
+    
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        pages = list(executor.map(_fetch_upload_pages, (text_uploads, image_uploads)))
+    uploads = pages[0] + pages[1]
+    uploads.sort(key=lambda u: (u.get('created_at') or '', str(u['id'])))
+    return uploads
+
+
+def load_image_contents(uploads: List[Dict]) -> List[Dict]:
+    """Return `uploads` with the content of image uploads fetched by `fetch_uploads` filled in."""
+    missing = [u['id'] for u in uploads if 'content' not in u]
+    if not missing:
+        return uploads
+    
     supabase = get_supabase()
-    response = supabase.table('uploads').select('*').eq('classroom_id', classroom_id).order('created_at').execute()
-    return response.data or []
+    contents = {}
+    for i in range(0, len(missing), IMAGE_CONTENT_BATCH_SIZE):
+        response = supabase.table('uploads').select('id, content').in_('id', missing[i:i + IMAGE_CONTENT_BATCH_SIZE]).execute()
+        contents.update((row['id'], row['content']) for row in response.data or [])
+    print(f"Downloaded {len(contents)} images")
+    return [u if 'content' in u else {**u, 'content': contents.get(u['id'], '')} for u in uploads]
 
 
 def fetch_messages(classroom_id: str) -> List[Dict]:
     """
-    Fetch messages for confusion analysis.
+    Fetch the most recent messages for confusion analysis.
     
     PRIVACY NOTE: These messages are processed locally and NEVER stored
     in a way that teachers can see individual messages. Only aggregated
     patterns are extracted and stored.
     """
     supabase = get_supabase()
-    response = supabase.table('messages').select('content').eq('classroom_id', classroom_id).execute()
-    return response.data or []
+    # Only recent messages are analyzed, so let the database do the slicing
+    # instead of transferring the whole history.
+    response = (
+        supabase.table('messages')
+        .select('content, created_at')
+        .eq('classroom_id', classroom_id)
+        .order('created_at', desc=True)
+        .limit(MESSAGE_SCAN_WINDOW)
+        .execute()
+    )
+    # Return in chronological order
+    return list(reversed(drop_repeated_messages(response.data or [], MESSAGE_WINDOW)))
+
+
+def _message_shingles(text: str) -> frozenset:
+    """Character 3-grams of a message, ignoring case, punctuation and spacing."""
+    normalized = ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+    if len(normalized) <= 3:
+        return frozenset([normalized])
+    return frozenset(normalized[i:i + 3] for i in range(len(normalized) - 2))
+
+
+def drop_repeated_messages(messages: List[Dict], limit: int) -> List[Dict]:
+    """
+    Keep up to `limit` messages, skipping near-duplicates of ones already kept.
+    
+    Chats are full of "same", "idk" and quoted replies that cost tokens without
+    adding signal. A message is dropped when its 3-gram Jaccard similarity to
+    a kept message reaches MESSAGE_DUPLICATE_SIMILARITY. Input order is kept,
+    so pass newest-first to prefer recent messages.
+    """
+    kept = []
+    kept_shingles = []
+    for message in messages:
+        shingles = _message_shingles(message.get('content') or '')
+        if any(
+            len(shingles & other) >= MESSAGE_DUPLICATE_SIMILARITY * len(shingles | other)
+            for other in kept_shingles
+        ):
+            continue
+        kept.append(message)
+        kept_shingles.append(shingles)
+        if len(kept) >= limit:
+            break
+    return kept
 
 
 def get_existing_study_guide(classroom_id: str) -> Optional[Dict]:
-    """Get the existing study guide for a classroom (if any)."""
+    """
+    Get the id and metadata of the existing study guide for a classroom (if any).
+    
+    The guide's content is only needed to merge new uploads into it, so it is
+    fetched separately with `get_insight_content` instead of on every run.
+    """
     supabase = get_supabase()
-    response = supabase.table('ai_insights').select('*').eq('classroom_id', classroom_id).eq('insight_type', 'study_guide').order('created_at', desc=True).limit(1).execute()
+    response = supabase.table('ai_insights').select('id, metadata').eq('classroom_id', classroom_id).eq('insight_type', 'study_guide').order('created_at', desc=True).limit(1).execute()
     return response.data[0] if response.data else None
 
 
-def get_processed_upload_ids(classroom_id: str) -> set:
-    """Get the set of upload IDs that have already been processed."""
-    existing = get_existing_study_guide(classroom_id)
+def get_insight_content(insight_id: str) -> Optional[str]:
+    """Get the content of a single AI insight."""
+    supabase = get_supabase()
+    response = supabase.table('ai_insights').select('content').eq('id', insight_id).limit(1).execute()
+    return response.data[0]['content'] if response.data else None
+
+
+def get_existing_confusion_summary(classroom_id: str) -> Optional[Dict]:
+    """Get the id and metadata of the existing confusion summary for a classroom (if any)."""
+    supabase = get_supabase()
+    response = supabase.table('ai_insights').select('id, metadata').eq('classroom_id', classroom_id).eq('insight_type', 'confusion_summary').limit(1).execute()
+    return response.data[0] if response.data else None
+
+
+def fetch_classroom_bundle(classroom_id: str, include_messages: bool = True, force_regenerate: bool = False) -> Dict:
+    """
+    Fetch everything `process_classroom` reads for a classroom.
+    
+    The queries are independent, so they are issued concurrently over the
+    pooled Supabase connection: one round-trip of latency instead of several.
+    The existing study guide is fetched exactly once here and passed down.
+    
+    Unless `force_regenerate` is set, only the upload IDs are read at first.
+    When the existing study guide is current for them (see
+    `is_study_guide_current`), the notes' content is not downloaded:
+    'uploads' then holds `{'id': ...}` rows only and 'uploads_unchanged' is
+    True. Otherwise the full uploads are fetched.
+    
+    Returns:
+        Dict with 'uploads', 'uploads_unchanged', 'study_guide' and (if
+        requested) 'messages' and 'confusion_summary'
+    """
+    queries = {
+        'uploads': fetch_uploads if force_regenerate else fetch_upload_ids,
+        'study_guide': get_existing_study_guide,
+    }
+    if include_messages:
+        queries['messages'] = fetch_messages
+        queries['confusion_summary'] = get_existing_confusion_summary
+    with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+        futures = {key: executor.submit(query, classroom_id) for key, query in queries.items()}
+        bundle = {key: future.result() for key, future in futures.items()}
+    
+    bundle['uploads_unchanged'] = False
+    if not force_regenerate:
+        upload_ids = bundle['uploads']
+        if upload_ids and is_study_guide_current(bundle['study_guide'], upload_ids):
+            bundle['uploads'] = [{'id': upload_id} for upload_id in upload_ids]
+            bundle['uploads_unchanged'] = True
+        else:
+            bundle['uploads'] = fetch_uploads(classroom_id) if upload_ids else []
+    return bundle
+
+
+def build_study_guide_metadata(uploads: List[Dict]) -> Dict:
+    """Build the metadata stored alongside a freshly generated study guide."""
+    return {
+        'processed_upload_ids': [u['id'] for u in uploads],
+        'upload_count': len(uploads),
+        'last_updated': utc_now_iso()
+    }
+
+
+def is_study_guide_current(existing: Optional[Dict], upload_ids: List[str]) -> bool:
+    """
+    Check whether an existing study guide was generated from exactly these uploads.
+    
+    Uploads are insert-only (there is no UPDATE policy or path), so the same
+    set of upload IDs means the same notes.
+    """
+    return bool(upload_ids) and _processed_ids_from_study_guide(existing) == set(upload_ids)
+
+
+def compute_messages_hash(messages: List[Dict]) -> str:
+    """Hash the analyzed message window; it changes whenever a new message arrives."""
+    digest = hashlib.sha256()
+    for m in messages:
+        digest.update((m.get('content') or '').encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _last_message_at(messages: List[Dict]) -> Optional[str]:
+    """Timestamp of the newest message (always kept by `fetch_messages`)."""
+    return messages[-1].get('created_at') if messages else None
+
+
+def build_confusion_metadata(messages: List[Dict]) -> Dict:
+    """Build the metadata stored alongside a freshly generated confusion summary."""
+    return {
+        'message_count': len(messages),
+        'messages_hash': compute_messages_hash(messages),
+        # Compared by classrooms_needing_ai_refresh() to spot new messages
+        'last_message_at': _last_message_at(messages),
+    }
+
+
+def is_confusion_summary_current(existing: Optional[Dict], messages: List[Dict]) -> bool:
+    """Check whether an existing confusion summary was generated from the same messages."""
+    stored_hash = ((existing or {}).get('metadata') or {}).get('messages_hash')
+    return stored_hash is not None and stored_hash == compute_messages_hash(messages)
+
+
+def mark_messages_seen(existing: Optional[Dict], messages: List[Dict]):
+    """
+    Record the newest message on a confusion summary that is still current.
+    
+    New messages that leave the analyzed window unchanged (near-duplicates,
+    or too old to be scanned) don't regenerate the summary; updating its
+    last_message_at keeps classrooms_needing_ai_refresh() from returning
+    the classroom on every bulk run.
+    """
+    last_message_at = _last_message_at(messages)
+    metadata = (existing or {}).get('metadata') or {}
+    if not existing or not last_message_at or metadata.get('last_message_at') == last_message_at:
+        return
+    supabase = get_supabase()
+    supabase.table('ai_insights').update(
+        {'metadata': {**metadata, 'last_message_at': last_message_at}}, returning='minimal'
+    ).eq('id', existing['id']).execute()
+
+
+def _processed_ids_from_study_guide(existing: Optional[Dict]) -> set:
+    """Extract the processed upload IDs recorded in a study guide's metadata."""
     if existing and existing.get('metadata'):
         return set(existing['metadata'].get('processed_upload_ids', []))
     return set()
 
 
-# Embeddings were removed when clustering was removed — no embedding model is required for the current pipeline.
+# Token counting (tiktoken when installed, otherwise a ~4 chars/token estimate)
+_token_encoder = None
+def _get_token_encoder():
+    global _token_encoder
+    if _token_encoder is None:
+        try:
+            import tiktoken
+        except ImportError:
+            _token_encoder = False
+        else:
+            try:
+                try:
+                    _token_encoder = tiktoken.encoding_for_model(OPENAI_MODEL)
+                except KeyError:
+                    # Unknown model name (or Gemini): the o200k vocabulary is a close approximation
+                    _token_encoder = tiktoken.get_encoding('o200k_base')
+            except Exception as e:
+                # The vocabulary is downloaded on first use (cached in TIKTOKEN_CACHE_DIR);
+                # without network access, estimate instead of failing every LLM call
+                print(f"Warning: tiktoken vocabulary unavailable, estimating token counts: {e}")
+                _token_encoder = False
+    return _token_encoder or None
+
+
+def count_tokens(text: str) -> int:
+    """Count (or estimate) the number of LLM tokens in `text`."""
+    encoder = _get_token_encoder()
+    if encoder is None:
+        return (len(text) + 3) // 4
+    return len(encoder.encode_ordinary(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, keep_end: bool = False) -> str:
+    """Truncate `text` to at most `max_tokens` tokens, keeping the start (or the end)."""
+    encoder = _get_token_encoder()
+    if encoder is None:
+        return text[-max_tokens * 4:] if keep_end and max_tokens > 0 else text[:max_tokens * 4]
+    tokens = encoder.encode_ordinary(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoder.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
+
+
+def study_guide_output_tokens(prompt: str, image_uploads: Optional[List[Dict]] = None) -> Optional[int]:
+    """
+    Output token cap for a study guide (or shard) prompt, sized to its input.
+    
+    Images carry content the token count can't see, so prompts with images
+    keep the provider default (None).
+    """
+    if image_uploads:
+        return None
+    return min(LLM_MAX_OUTPUT_TOKENS, max(STUDY_GUIDE_MIN_OUTPUT_TOKENS, 2 * count_tokens(prompt)))
+
+
+CONFUSION_PROMPT_HEAD = """Analyze these classroom chat messages to identify common topics where students seem confused or are asking questions.
 
+MESSAGES (anonymized):
+"""
+
+CONFUSION_PROMPT_TAIL = """
+
+Provide a brief summary of:
+1. Topics students seem to struggle with most
+2. Common questions or misconceptions
+3. Suggested areas for the teacher to review
 
-# Clustering and unit-name generation removed to simplify the pipeline.
-# All uploads are combined and passed to `generate_study_guide_from_uploads` which produces a single comprehensive study guide.
+IMPORTANT: Do NOT quote any specific messages or identify any students. 
+Only provide aggregated, anonymous insights about learning patterns.
+Keep the response concise (under 200 words)."""
 
 
-def analyze_confusion_patterns(messages: List[Dict]) -> str:
+def build_confusion_prompt(messages: List[Dict]) -> Optional[str]:
+    """Build the confusion-analysis prompt, or None if there is too little chat to analyze."""
+    if not messages:
+        return None
+    
+    # Extract just the content
+    all_messages = [m['content'] for m in messages][-MESSAGE_WINDOW:]  # Most recent messages
+    if sum(len(content) for content in all_messages) < 50:
+        return None
+    
+    # Over budget, drop whole messages, oldest first, rather than cutting one mid-sentence
+    recent = []
+    used_tokens = 0
+    for content in reversed(all_messages):
+        tokens = count_tokens(content) + 1  # +1 for the newline separator
+        if used_tokens + tokens > CONFUSION_MAX_INPUT_TOKENS:
+            if not recent:
+                # A single message longer than the whole budget: keep its end
+                recent.append(truncate_to_tokens(content, CONFUSION_MAX_INPUT_TOKENS, keep_end=True))
+            break
+        recent.append(content)
+        used_tokens += tokens
+    combined = "\n".join(reversed(recent))
+    
+    return "".join((CONFUSION_PROMPT_HEAD, combined, CONFUSION_PROMPT_TAIL))
+
+
+def analyze_confusion_patterns(messages: List[Dict]) -> Optional[str]:
     """
     Analyze chat messages to identify common confusion topics.
     
@@ -145,182 +646,555 @@ def analyze_confusion_patterns(messages: List[Dict]) -> str:
     
     This is a key privacy-preserving feature: teachers get actionable
     insights without surveillance of individual students.
+    
+    Returns None if the LLM call fails, so the error is never stored as
+    the current summary.
     """
-    if not messages:
+    prompt = build_confusion_prompt(messages)
+    if prompt is None:
         return "Not enough chat data to analyze confusion patterns yet."
     
-    # Extract just the content
-    all_messages = [m['content'] for m in messages]
-    combined = "\n".join(all_messages[-100:])  # Last 100 messages
+    try:
+        # Unchanged chat windows produce the same prompt, so reuse the last answer
+        return call_llm_cached(prompt, CONFUSION_MAX_OUTPUT_TOKENS)
+    except Exception as e:
+        print(f"Error analyzing confusion: {e}")
+        return None
+
+
+# Receives each chunk of generated text as it streams in from the provider
+TextCallback = Callable[[str], None]
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `rate` tokens per second (0 disables).
     
-    if len(combined) < 50:
-        return "Not enough chat data to analyze confusion patterns yet."
+    `acquire(n)` reserves n tokens and sleeps until they are available, so
+    concurrent callers are queued in arrival order; `pause(seconds)` holds
+    every caller back, e.g. after the provider answers 429.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self._paused_until - now)
+            if self.rate > 0:
+                tokens = min(tokens, self.capacity)
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                self._tokens -= tokens
+                if self._tokens < 0:
+                    wait = max(wait, -self._tokens / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_llm_request_bucket = TokenBucket(LLM_REQUESTS_PER_SECOND, capacity=1)
+_llm_token_bucket = TokenBucket(LLM_TOKENS_PER_MINUTE / 60, capacity=LLM_TOKENS_PER_MINUTE)
+_llm_call_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENT_CALLS) if LLM_MAX_CONCURRENT_CALLS > 0 else nullcontext()
+
+
+class CircuitBreaker:
+    """
+    Tracks consecutive failures of one provider.
     
-    prompt = f"""Analyze these classroom chat messages to identify common topics where students seem confused or are asking questions.
+    After `threshold` failures in a row the breaker opens and `available()`
+    returns False for `cooldown` seconds; the next call after that is a trial,
+    and a single success closes it again.
+    """
 
-MESSAGES (anonymized):
-{combined[:4000]}
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
 
-Provide a brief summary of:
-1. Topics students seem to struggle with most
-2. Common questions or misconceptions
-3. Suggested areas for the teacher to review
+    def available(self) -> bool:
+        return time.monotonic() >= self._open_until
 
-IMPORTANT: Do NOT quote any specific messages or identify any students. 
-Only provide aggregated, anonymous insights about learning patterns.
-Keep the response concise (under 200 words)."""
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
 
-    try:
-        return call_llm(prompt)
-    except Exception as e:
-        print(f"Error analyzing confusion: {e}")
-        return f"Confusion analysis failed: {str(e)}"
+    def record_failure(self) -> bool:
+        """Count a failure; returns True if this one opened the breaker."""
+        with self._lock:
+            self._failures += 1
+            if self.threshold <= 0 or self._failures < self.threshold:
+                return False
+            self._failures = 0
+            self._open_until = time.monotonic() + self.cooldown
+            return True
 
 
-def call_llm(prompt: str) -> str:
-    """Call the configured LLM provider to generate text."""
-    if AI_PROVIDER == 'gemini':
-        return _call_gemini(prompt)
-    elif AI_PROVIDER == 'openai':
-        return _call_openai(prompt)
-    else:
-        raise Exception(f"Unknown AI provider: {AI_PROVIDER}")
+_provider_breakers = {
+    name: CircuitBreaker(PROVIDER_FAILURE_THRESHOLD, PROVIDER_COOLDOWN)
+    for name in ('gemini', 'openai')
+}
 
 
-def call_llm_with_images(prompt: str, image_uploads: List[Dict]) -> str:
-    """Call the configured LLM provider with images (vision capability)."""
-    if AI_PROVIDER == 'gemini':
-        return _call_gemini_with_images(prompt, image_uploads)
-    elif AI_PROVIDER == 'openai':
-        return _call_openai_with_images(prompt, image_uploads)
-    else:
+def _llm_providers() -> List[str]:
+    """Providers to try for one call: the configured one, then the fallback."""
+    if AI_PROVIDER not in _provider_breakers:
         raise Exception(f"Unknown AI provider: {AI_PROVIDER}")
+    providers = [AI_PROVIDER]
+    if AI_FALLBACK_PROVIDER in _provider_breakers and AI_FALLBACK_PROVIDER != AI_PROVIDER:
+        providers.append(AI_FALLBACK_PROVIDER)
+    # Skip providers whose breaker is open, unless every one of them is
+    return [p for p in providers if _provider_breakers[p].available()] or providers
 
 
-def _call_gemini(prompt: str) -> str:
-    """Call Google Gemini API to generate text."""
-    import google.generativeai as genai
+def _call_with_failover(call: Callable[[str, Optional[TextCallback]], str], prompt: str,
+                        on_text: Optional[TextCallback] = None, max_tokens: Optional[int] = None) -> str:
+    """
+    Run `call(provider, on_text)` against each provider in turn until one succeeds.
+    
+    A call that already streamed text is not retried elsewhere, since the
+    listener would receive a second copy of the output.
+    """
+    streamed = False
+
+    def track(text: str):
+        nonlocal streamed
+        streamed = True
+        on_text(text)
+
+    providers = _llm_providers()
+    for i, provider in enumerate(providers):
+        try:
+            result = _call_with_limits(
+                lambda: call(provider, track if on_text else None), prompt, provider, max_tokens,
+                can_retry=lambda: not streamed,
+            )
+        except Exception as e:
+            if _provider_breakers[provider].record_failure():
+                print(f"{provider} failed {PROVIDER_FAILURE_THRESHOLD} times in a row, skipping it for {PROVIDER_COOLDOWN:.0f}s")
+            if streamed or i == len(providers) - 1:
+                raise
+            print(f"{provider} call failed ({e}), falling back to {providers[i + 1]}")
+            continue
+        _provider_breakers[provider].record_success()
+        return result
+
+
+def call_llm(prompt: str, on_text: Optional[TextCallback] = None, max_tokens: Optional[int] = None) -> str:
+    """
+    Call the configured LLM provider to generate text.
+    
+    `max_tokens` caps the response length (default: LLM_MAX_OUTPUT_TOKENS).
+    Short answers should pass a small cap so they reserve less of the
+    provider's token-per-minute limit.
+    """
+    return _call_llm_with_provider(prompt, on_text, max_tokens)[0]
+
+
+def _call_llm_with_provider(prompt: str, on_text: Optional[TextCallback] = None,
+                            max_tokens: Optional[int] = None) -> Tuple[str, str]:
+    """`call_llm`, also returning the provider that answered (the fallback after a failover)."""
+    answered_by = AI_PROVIDER
+
+    def call(provider: str, on_text: Optional[TextCallback]) -> str:
+        nonlocal answered_by
+        answered_by = provider
+        if provider == 'gemini':
+            return _call_gemini(prompt, on_text, max_tokens)
+        return _call_openai(prompt, on_text, max_tokens)
+    return _call_with_failover(call, prompt, on_text, max_tokens), answered_by
+
+
+def _rate_limit_delay(error: Exception, attempt: int) -> Optional[float]:
+    """Seconds to wait before retrying a rate-limited (429) call, or None for other errors."""
+    # The provider wrappers re-raise with the SDK error as the context
+    exc = error
+    while exc is not None:
+        status = getattr(exc, 'status_code', None) or getattr(exc, 'code', None)
+        if status == 429 or type(exc).__name__ in ('RateLimitError', 'ResourceExhausted', 'TooManyRequests'):
+            response = getattr(exc, 'response', None)
+            headers = getattr(response, 'headers', None) or {}
+            try:
+                return float(headers.get('retry-after'))
+            except (TypeError, ValueError):
+                return LLM_RATE_LIMIT_BACKOFF * 2 ** attempt
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+def _is_transient_error(error: Exception) -> bool:
+    """Whether a failed call hit a provider hiccup (5xx, dropped connection) worth retrying."""
+    exc = error
+    transient = False
+    while exc is not None:
+        name = type(exc).__name__
+        # Timeouts already waited LLM_TIMEOUT; retrying would multiply that
+        if name in ('APITimeoutError', 'DeadlineExceeded', 'TimeoutException', 'ReadTimeout'):
+            return False
+        status = getattr(exc, 'status_code', None) or getattr(exc, 'code', None)
+        if status in (500, 502, 503) or name in ('InternalServerError', 'ServiceUnavailable', 'APIConnectionError'):
+            transient = True
+        exc = exc.__cause__ or exc.__context__
+    return transient
+
+
+def _call_with_limits(call: Callable[[], str], prompt: str, provider: str = AI_PROVIDER,
+                      max_tokens: Optional[int] = None, can_retry: Callable[[], bool] = lambda: True) -> str:
+    """
+    Run one provider call under the concurrency cap and rate limits.
     
-    if not GEMINI_API_KEY:
-        raise Exception("GEMINI_API_KEY is not set")
+    429s are retried after the provider's Retry-After (or an exponential
+    backoff) with every caller held back; transient 5xx and connection
+    errors are retried with the same backoff by this caller alone.
+    `can_retry` returning False (e.g. text was already streamed) disables both.
+    """
+    output_tokens = min(LLM_OUTPUT_TOKEN_ESTIMATE, max_tokens or LLM_OUTPUT_TOKEN_ESTIMATE)
+    tokens = count_tokens(prompt) + output_tokens if LLM_TOKENS_PER_MINUTE > 0 else 0
+    for attempt in range(LLM_RATE_LIMIT_RETRIES + 1):
+        # Wait for rate-limit budget before taking a concurrency slot, so
+        # paused or throttled callers don't hold slots others could use
+        _llm_request_bucket.acquire()
+        _llm_token_bucket.acquire(tokens)
+        try:
+            with _llm_call_slots:
+                return call()
+        except Exception as e:
+            delay = _rate_limit_delay(e, attempt)
+            transient = delay is None and _is_transient_error(e)
+            if (delay is None and not transient) or attempt == LLM_RATE_LIMIT_RETRIES or not can_retry():
+                raise
+            error = str(e)
+        if transient:
+            delay = LLM_RATE_LIMIT_BACKOFF * 2 ** attempt
+            print(f"{provider} request failed ({error}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
+        else:
+            print(f"Rate limited by {provider}, retrying in {delay:.0f}s...")
+            _llm_request_bucket.pause(delay)
+
+
+def _llm_cache_key(prompt: str, max_tokens: Optional[int] = None) -> str:
+    # Keyed on the configured provider; answers from the fallback provider
+    # are never stored (see `_call_llm_for_cache`)
+    model = GEMINI_MODEL if AI_PROVIDER == 'gemini' else OPENAI_MODEL
+    # Case and indentation matter in notes (code, formulas), so only
+    # trailing whitespace is ignored
+    digest = hashlib.sha256(prompt.rstrip().encode('utf-8')).hexdigest()
+    return f"classly-ai:llm:{AI_PROVIDER}:{model}:{max_tokens or LLM_MAX_OUTPUT_TOKENS}:{digest}"
+
+
+def _call_llm_for_cache(prompt: str, max_tokens: Optional[int] = None) -> Tuple[str, bool]:
+    """`call_llm` for the caches: returns the text and whether it may be stored."""
+    text, provider = _call_llm_with_provider(prompt, max_tokens=max_tokens)
+    # Don't cache blocked or empty responses, or the fallback provider's
+    # answer under the configured provider's key
+    return text, bool(text) and provider == AI_PROVIDER
+
+
+_local_llm_cache: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_local_llm_cache_lock = threading.Lock()
+
+def _call_llm_local_cached(key: str, prompt: str, max_tokens: Optional[int] = None) -> str:
+    """`call_llm` through a small in-process LRU cache with LLM_CACHE_TTL expiry."""
+    with _local_llm_cache_lock:
+        entry = _local_llm_cache.get(key)
+        if entry and entry[0] > time.monotonic():
+            _local_llm_cache.move_to_end(key)
+            print("Reusing cached LLM response.")
+            return entry[1]
+    
+    text, cacheable = _call_llm_for_cache(prompt, max_tokens)
+    if not cacheable:
+        return text
+    with _local_llm_cache_lock:
+        _local_llm_cache[key] = (time.monotonic() + LLM_CACHE_TTL, text)
+        _local_llm_cache.move_to_end(key)
+        while len(_local_llm_cache) > LLM_LOCAL_CACHE_SIZE:
+            _local_llm_cache.popitem(last=False)
+    return text
+
+
+_disk_llm_cache = None
+_disk_llm_cache_lock = threading.Lock()
+
+def _get_disk_llm_cache():
+    """Open the SQLite LLM cache at LLM_CACHE_PATH (callers hold `_disk_llm_cache_lock`)."""
+    global _disk_llm_cache
+    if _disk_llm_cache is None:
+        import sqlite3
+        # Several server processes may share the file; wait out their write locks
+        _disk_llm_cache = sqlite3.connect(LLM_CACHE_PATH, timeout=30, check_same_thread=False)
+        _disk_llm_cache.execute(
+            'CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL NOT NULL)'
+        )
+        _disk_llm_cache.commit()
+    return _disk_llm_cache
+
+
+def _shared_cache_get(redis, key: str) -> Optional[str]:
+    if redis is not None:
+        cached = redis.get(key)
+        return cached.decode('utf-8') if cached is not None else None
+    with _disk_llm_cache_lock:
+        row = _get_disk_llm_cache().execute(
+            'SELECT response FROM llm_cache WHERE key = ? AND expires_at > ?', (key, time.time())
+        ).fetchone()
+    return row[0] if row else None
+
+
+def _shared_cache_set(redis, key: str, text: str):
+    if redis is not None:
+        redis.set(key, text, ex=LLM_CACHE_TTL)
+        return
+    now = time.time()
+    with _disk_llm_cache_lock:
+        db = _get_disk_llm_cache()
+        db.execute('INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)', (key, text, now + LLM_CACHE_TTL))
+        db.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
+        db.commit()
+
+
+def call_llm_cached(prompt: str, max_tokens: Optional[int] = None) -> str:
+    """
+    Like `call_llm`, but answers identical prompts from a cache for LLM_CACHE_TTL seconds.
     
-    genai.configure(api_key=GEMINI_API_KEY)
+    The cache lives in Redis when REDIS_URL is set (shared by all processes),
+    else in the SQLite file LLM_CACHE_PATH if configured, otherwise in this
+    process. Use it only for text-only prompts whose answer may be reused
+    verbatim.
+    """
+    key = _llm_cache_key(prompt, max_tokens)
+    redis = get_redis()
+    if redis is None and not LLM_CACHE_PATH:
+        return _call_llm_local_cached(key, prompt, max_tokens)
     
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.9,
-        "max_output_tokens": 16384,
-    }
+    try:
+        cached = _shared_cache_get(redis, key)
+        if cached is not None:
+            print("Reusing cached LLM response.")
+            return cached
+    except Exception as e:
+        print(f"Warning: LLM cache lookup failed: {e}")
     
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
+    text, cacheable = _call_llm_for_cache(prompt, max_tokens)
+    if not cacheable:
+        return text
+    try:
+        _shared_cache_set(redis, key, text)
+    except Exception as e:
+        print(f"Warning: LLM cache store failed: {e}")
+    return text
+
+
+def call_llm_with_images(prompt: str, image_uploads: List[Dict], on_text: Optional[TextCallback] = None,
+                         max_tokens: Optional[int] = None) -> str:
+    """Call the configured LLM provider with images (vision capability)."""
+    gemini_parts = None
+
+    def call(provider: str, on_text: Optional[TextCallback]) -> str:
+        nonlocal gemini_parts
+        if provider == 'gemini':
+            # Decode once; rate-limit retries reuse the same image bytes
+            if gemini_parts is None:
+                gemini_parts = _gemini_image_parts(image_uploads)
+            return _call_gemini_with_images(prompt, gemini_parts, on_text, max_tokens)
+        return _call_openai_with_images(prompt, image_uploads, on_text, max_tokens)
+    return _call_with_failover(call, prompt, on_text, max_tokens)
+
+
+# Gemini generation settings (shared by every request)
+GEMINI_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.9,
+    "max_output_tokens": LLM_MAX_OUTPUT_TOKENS,
+}
+
+GEMINI_SAFETY_SETTINGS = [
+    {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
+    {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
+]
+
+# LLM clients (lazy, created once per process and reused across requests)
+_gemini_model = None
+def get_gemini_model():
+    global _gemini_model
+    if _gemini_model is None:
+        with _clients_lock:
+            if _gemini_model is None:
+                # Imported here so only the provider in use is ever loaded
+                try:
+                    import google.generativeai as genai
+                except ImportError:
+                    raise Exception("google-generativeai is not installed (pip install google-generativeai)")
+                if not GEMINI_API_KEY:
+                    raise Exception("GEMINI_API_KEY is not set")
+
+                genai.configure(api_key=GEMINI_API_KEY)
+                _gemini_model = genai.GenerativeModel(
+                    model_name=GEMINI_MODEL,
+                    generation_config=GEMINI_GENERATION_CONFIG,
+                    safety_settings=GEMINI_SAFETY_SETTINGS
+                )
+    return _gemini_model
+
+
+OPENAI_SYSTEM_PROMPT = "You are a helpful educational assistant that creates study guides and analyzes learning patterns."
+
+_openai_client = None
+def get_openai_client():
+    global _openai_client
+    if _openai_client is None:
+        with _clients_lock:
+            if _openai_client is None:
+                # Imported here so only the provider in use is ever loaded
+                try:
+                    from openai import OpenAI
+                except ImportError:
+                    raise Exception("openai is not installed (pip install openai)")
+                if not OPENAI_API_KEY:
+                    raise Exception("OPENAI_API_KEY is not set")
+
+                import httpx
+
+                # httpx drops idle connections after 5s by default, so calls spaced out
+                # by a bulk run or the rate limiter would each pay a new TLS handshake.
+                # Keep them warm longer, with one pooled connection per allowed call.
+                http_client = httpx.Client(limits=httpx.Limits(
+                    max_connections=LLM_MAX_CONCURRENT_CALLS or None,
+                    max_keepalive_connections=LLM_MAX_CONCURRENT_CALLS or 20,
+                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                ))
+                _openai_client = OpenAI(api_key=OPENAI_API_KEY, timeout=LLM_TIMEOUT, http_client=http_client)
+    return _openai_client
+
+
+def _collect_gemini_stream(response, on_text: Optional[TextCallback] = None) -> str:
+    """
+    Accumulate a streamed Gemini response into the full text.
+    
+    Streaming lets the provider hand back tokens as they are produced, so the
+    call returns as soon as generation finishes instead of after the whole
+    body has been buffered server-side. `on_text` sees each chunk on arrival.
+    """
+    parts = []
+    for chunk in response:
+        if chunk.parts:
+            parts.append(chunk.text)
+            if on_text:
+                on_text(chunk.text)
+    
+    # Check if response was blocked
+    if not parts:
+        print(f"Gemini response blocked or empty. Candidates: {response.candidates}")
+        if response.candidates and response.candidates[0].finish_reason:
+            print(f"Finish reason: {response.candidates[0].finish_reason}")
+        return ""
+    
+    return "".join(parts)
+
+
+def _collect_openai_stream(stream, on_text: Optional[TextCallback] = None) -> str:
+    """Accumulate a streamed OpenAI chat completion into the full text."""
+    parts = []
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            parts.append(chunk.choices[0].delta.content)
+            if on_text:
+                on_text(chunk.choices[0].delta.content)
+    return "".join(parts)
+
+
+def _gemini_generation_config(max_tokens: Optional[int]) -> Optional[Dict]:
+    """Per-request generation config overriding the model's output cap, or None for the default."""
+    if not max_tokens:
+        return None
+    return {**GEMINI_GENERATION_CONFIG, "max_output_tokens": min(max_tokens, LLM_MAX_OUTPUT_TOKENS)}
+
+
+def _call_gemini(prompt: str, on_text: Optional[TextCallback] = None, max_tokens: Optional[int] = None) -> str:
+    """Call Google Gemini API to generate text."""
+    model = get_gemini_model()
     
     try:
-        model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL,
-            generation_config=generation_config,
-            safety_settings=safety_settings
+        response = model.generate_content(
+            prompt,
+            generation_config=_gemini_generation_config(max_tokens),
+            stream=True,
+            request_options={'timeout': LLM_TIMEOUT},
         )
-        response = model.generate_content(prompt)
-        
-        # Check if response was blocked
-        if not response.parts:
-            print(f"Gemini response blocked or empty. Candidates: {response.candidates}")
-            if response.candidates and response.candidates[0].finish_reason:
-                print(f"Finish reason: {response.candidates[0].finish_reason}")
-            return ""
         
-        return response.text
+        return _collect_gemini_stream(response, on_text)
     except Exception as e:
         print(f"Gemini API exception: {e}")
-        import traceback
         traceback.print_exc()
         raise Exception(f"Gemini API error: {str(e)}")
 
 
-def _call_gemini_with_images(prompt: str, image_uploads: List[Dict]) -> str:
-    """Call Google Gemini API with images (vision capability)."""
-    import google.generativeai as genai
-    import base64
-    import re
-    
-    if not GEMINI_API_KEY:
-        raise Exception("GEMINI_API_KEY is not set")
-    
-    genai.configure(api_key=GEMINI_API_KEY)
-    
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.9,
-        "max_output_tokens": 16384,
+# base64 image data URL: data:image/<subtype>;base64,<data>
+IMAGE_DATA_URL_PATTERN = re.compile(r'data:image/(\w+);base64,(.+)', re.DOTALL)
+
+
+def _decode_image_part(img_upload: Dict) -> Optional[Dict]:
+    """Decode an image upload's data URL into a Gemini inline-data part."""
+    match = IMAGE_DATA_URL_PATTERN.match(img_upload['content'])
+    if not match:
+        return None
+    return {
+        "mime_type": f"image/{match.group(1)}",
+        "data": base64.b64decode(match.group(2))
     }
-    
-    safety_settings = [
-        {"category": "HARM_CATEGORY_HARASSMENT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_HATE_SPEECH", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_SEXUALLY_EXPLICIT", "threshold": "BLOCK_NONE"},
-        {"category": "HARM_CATEGORY_DANGEROUS_CONTENT", "threshold": "BLOCK_NONE"},
-    ]
+
+
+def _gemini_image_parts(image_uploads: List[Dict]) -> List:
+    """Decode image uploads into Gemini content parts, each followed by its title."""
+    parts = []
+    for img_upload in image_uploads:
+        image_part = _decode_image_part(img_upload)
+        if image_part:
+            parts.append(image_part)
+            parts.append(f"\n[Image: {img_upload['title']}]\n")
+    return parts
+
+
+def _call_gemini_with_images(prompt: str, image_parts: List, on_text: Optional[TextCallback] = None,
+                             max_tokens: Optional[int] = None) -> str:
+    """Call Google Gemini API with images (vision capability) from `_gemini_image_parts`."""
+    model = get_gemini_model()
     
     try:
-        model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        
-        # Build content parts: text prompt + images
-        content_parts = [prompt]
-        
-        for img_upload in image_uploads:
-            img_data_url = img_upload['content']
-            title = img_upload['title']
-            
-            # Extract base64 data and mime type from data URL
-            match = re.match(r'data:image/(\w+);base64,(.+)', img_data_url)
-            if match:
-                mime_type = f"image/{match.group(1)}"
-                base64_data = match.group(2)
-                
-                # Decode base64 to bytes
-                image_bytes = base64.b64decode(base64_data)
-                
-                # Add image with description
-                content_parts.append({
-                    "mime_type": mime_type,
-                    "data": image_bytes
-                })
-                content_parts.append(f"\n[Image: {title}]\n")
+        # Content parts: text prompt + images (Gemini wants raw bytes)
+        content_parts = [prompt, *image_parts]
         
-        response = model.generate_content(content_parts)
-        
-        # Check if response was blocked
-        if not response.parts:
-            print(f"Gemini response blocked or empty. Candidates: {response.candidates}")
-            if response.candidates and response.candidates[0].finish_reason:
-                print(f"Finish reason: {response.candidates[0].finish_reason}")
-            return ""
+        response = model.generate_content(
+            content_parts,
+            generation_config=_gemini_generation_config(max_tokens),
+            stream=True,
+            request_options={'timeout': LLM_TIMEOUT},
+        )
         
-        return response.text
+        return _collect_gemini_stream(response, on_text)
     except Exception as e:
         print(f"Gemini API exception: {e}")
-        import traceback
         traceback.print_exc()
         raise Exception(f"Gemini API error: {str(e)}")
 
 
-def _call_openai(prompt: str) -> str:
+def _call_openai(prompt: str, on_text: Optional[TextCallback] = None, max_tokens: Optional[int] = None) -> str:
     """Call OpenAI API to generate text."""
-    from openai import OpenAI
-    
-    if not OPENAI_API_KEY:
-        raise Exception("OPENAI_API_KEY is not set")
-    
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client()
     
     try:
         response = client.chat.completions.create(
@@ -328,35 +1202,29 @@ def _call_openai(prompt: str) -> str:
             messages=[
                 {
                     "role": "system",
-                    "content": "You are a helpful educational assistant that creates study guides and analyzes learning patterns."
+                    "content": OPENAI_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": prompt
                 }
             ],
-            # max_completion_tokens=16384,
+            max_completion_tokens=max_tokens,  # None keeps the model's own limit
+            stream=True,
         )
-        result = response.choices[0].message.content or ""
+        result = _collect_openai_stream(response, on_text)
         print(f"OpenAI returned {len(result)} chars")
         return result
     except Exception as e:
         print(f"OpenAI API exception: {e}")
-        import traceback
         traceback.print_exc()
         raise Exception(f"OpenAI API error: {str(e)}")
 
 
-def _call_openai_with_images(prompt: str, image_uploads: List[Dict]) -> str:
+def _call_openai_with_images(prompt: str, image_uploads: List[Dict], on_text: Optional[TextCallback] = None,
+                             max_tokens: Optional[int] = None) -> str:
     """Call OpenAI API with images (vision capability)."""
-    from openai import OpenAI
-    import base64
-    import re
-    
-    if not OPENAI_API_KEY:
-        raise Exception("OPENAI_API_KEY is not set")
-    
-    client = OpenAI(api_key=OPENAI_API_KEY)
+    client = get_openai_client()
     
     try:
         # Build messages with images
@@ -372,23 +1240,18 @@ def _call_openai_with_images(prompt: str, image_uploads: List[Dict]) -> str:
         
         for img_upload in image_uploads:
             img_data_url = img_upload['content']
-            title = img_upload['title']
             
-            # Extract base64 data and mime type from data URL
-            match = re.match(r'data:image/(\w+);base64,(.+)', img_data_url)
-            if match:
-                mime_type = f"image/{match.group(1)}"
-                base64_data = match.group(2)
-                
+            # OpenAI accepts data URLs directly, so only the prefix is checked
+            if img_data_url.startswith('data:image/'):
                 content.append({
                     "type": "image_url",
                     "image_url": {
-                        "url": img_data_url  # OpenAI accepts data URLs directly
+                        "url": img_data_url
                     }
                 })
                 content.append({
                     "type": "text",
-                    "text": f"[Image: {title}]"
+                    "text": f"[Image: {img_upload['title']}]"
                 })
         
         messages.append({
@@ -402,13 +1265,13 @@ def _call_openai_with_images(prompt: str, image_uploads: List[Dict]) -> str:
         response = client.chat.completions.create(
             model=OPENAI_MODEL,
             messages=messages,
-            # max_completion_tokens=16384,
+            max_completion_tokens=max_tokens,  # None keeps the model's own limit
+            stream=True,
         )
-        result = response.choices[0].message.content or ""
+        result = _collect_openai_stream(response, on_text)
         return result
     except Exception as e:
         print(f"OpenAI API exception: {e}")
-        import traceback
         traceback.print_exc()
         raise Exception(f"OpenAI API error: {str(e)}")
 
@@ -424,50 +1287,139 @@ def store_insight(classroom_id: str, insight_type: str, content: str, unit_name:
         'metadata': metadata or {}
     }
     
-    supabase.table('ai_insights').insert(data).execute()
+    supabase.table('ai_insights').insert(data, returning='minimal').execute()
     print(f"  ✓ Stored {insight_type}" + (f" for {unit_name}" if unit_name else ""))
 
 
+# Unique key of ai_insights rows (see supabase-upgrade.sql)
+INSIGHT_CONFLICT_COLUMNS = 'classroom_id,insight_type,unit_name'
+STUDY_GUIDE_UNIT_NAME = 'Complete Study Guide'
+
+
+def _insight_row(classroom_id: str, insight_type: str, content: str, unit_name: Optional[str] = None, metadata: Dict = None) -> Dict:
+    """Build an ai_insights row for an upsert."""
+    return {
+        'classroom_id': classroom_id,
+        'insight_type': insight_type,
+        'content': content,
+        'unit_name': unit_name,
+        'metadata': metadata or {}
+        # created_at is stamped by the database (see supabase-upgrade.sql)
+    }
+
+
+def upsert_insight(classroom_id: str, insight_type: str, content: str, unit_name: Optional[str] = None, metadata: Dict = None):
+    """
+    Create or replace an AI insight in a single round-trip.
+    
+    Relies on the unique (classroom_id, insight_type, unit_name) constraint on
+    ai_insights, so concurrent generations can never create duplicate rows.
+    """
+    upsert_insights([_insight_row(classroom_id, insight_type, content, unit_name, metadata)])
+
+
+def upsert_insights(rows: List[Dict]):
+    """Create or replace several AI insight rows (see `_insight_row`) in one round-trip."""
+    if not rows:
+        return
+    supabase = get_supabase()
+    # The saved rows aren't read back, so don't have PostgREST echo them
+    # (study guides are large)
+    supabase.table('ai_insights').upsert(rows, on_conflict=INSIGHT_CONFLICT_COLUMNS, returning='minimal').execute()
+    for row in rows:
+        print(f"  ✓ Saved {row['insight_type']}" + (f" for {row['unit_name']}" if row['unit_name'] else ""))
+
+
+def update_or_create_confusion_summary(classroom_id: str, content: str, messages: List[Dict]):
+    """Update the existing confusion summary or create a new one."""
+    upsert_insight(
+        classroom_id=classroom_id,
+        insight_type='confusion_summary',
+        content=content,
+        metadata=build_confusion_metadata(messages)
+    )
+
+
 def update_or_create_study_guide(classroom_id: str, content: str, metadata: Dict):
     """Update existing study guide or create a new one."""
-    supabase = get_supabase()
-    existing = get_existing_study_guide(classroom_id)
-    
-    if existing:
-        # Update existing study guide
-        supabase.table('ai_insights').update({
-            'content': content,
-            'metadata': metadata,
-            'created_at': datetime.utcnow().isoformat()
-        }).eq('id', existing['id']).execute()
-        print("  ✓ Updated existing study guide")
-    else:
-        # Create new study guide
-        store_insight(
-            classroom_id=classroom_id,
-            insight_type='study_guide',
-            content=content,
-            unit_name='Complete Study Guide',
-            metadata=metadata
-        )
+    upsert_insight(
+        classroom_id=classroom_id,
+        insight_type='study_guide',
+        content=content,
+        unit_name=STUDY_GUIDE_UNIT_NAME,
+        metadata=metadata
+    )
+
+
+def _format_notes(text_uploads: List[Dict]) -> str:
+    """Join text uploads into the `--- Note N: title ---` notes block."""
+    return "".join(
+        f"\n--- Note {upload['index']}: {upload['title']} ---\n{upload['content']}\n"
+        for upload in text_uploads
+    )
+
+
+def _summarize_note_shard(shard: List[Dict]) -> str:
+    """Condense a shard of text uploads into dense unit notes (map step)."""
+    notes_text = _format_notes(shard)
+    prompt = f"""You are condensing class notes that will later be merged into a single study guide.
+
+NOTES:
+{notes_text}
+
+TASK:
+Rewrite these notes as dense, well-organized unit notes in Markdown.
+- Keep every concept, definition, formula, worked example, and common pitfall.
+- Keep LaTeX-style math formatting ($...$ inline, $$...$$ displayed).
+- Group related material under the topic or unit it belongs to.
+- Do NOT add review questions or commentary — only the condensed content."""
+    # Unchanged shards (e.g. when a full regeneration follows a deleted note)
+    # are answered from the cache
+    return call_llm_cached(prompt, study_guide_output_tokens(prompt))
 
 
-def generate_study_guide_from_uploads(uploads: List[Dict]) -> str:
+def condense_notes_in_shards(text_uploads: List[Dict]) -> str:
     """
-    Generate a single comprehensive study guide from all uploads.
+    Condense text uploads in shards of STUDY_GUIDE_SHARD_SIZE notes.
     
-    Takes all uploaded notes and sends them to the LLM to create
-    one study guide organized by unit/topic.
-    Supports both text and image uploads (images are sent directly to vision models).
+    Each shard is summarized by its own LLM call and the calls run
+    concurrently; the condensed shards are returned as a single notes text
+    ready for the study guide prompt. A shard whose call fails falls back
+    to its original notes so no content is lost.
     """
-    # Separate text and image uploads
+    shards = [
+        text_uploads[i:i + STUDY_GUIDE_SHARD_SIZE]
+        for i in range(0, len(text_uploads), STUDY_GUIDE_SHARD_SIZE)
+    ]
+    print(f"  Condensing {len(text_uploads)} notes in {len(shards)} shards...")
+    
+    def summarize(shard: List[Dict]) -> str:
+        try:
+            summary = _summarize_note_shard(shard)
+            if summary and summary.strip():
+                return summary
+        except Exception as e:
+            print(f"  Shard summarization failed, using original notes: {e}")
+        return _format_notes(shard)
+    
+    with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        summaries = list(executor.map(summarize, shards))
+    
+    return "".join(
+        f"\n--- Notes {shard[0]['index']}-{shard[-1]['index']} (condensed) ---\n{summary}\n"
+        for shard, summary in zip(shards, summaries)
+    )
+
+
+def _split_uploads(uploads: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+    """Separate uploads into text notes and images (base64 data URLs)."""
     text_uploads = []
     image_uploads = []
     
     for i, upload in enumerate(uploads, 1):
         title = upload.get('title', f'Note {i}')
         content = upload.get('content', '')
-        file_type = upload.get('file_type', 'text')
+        file_type = upload.get('file_type') or 'text'
         
         # Check if content is a base64 image
         is_image = content.startswith('data:image/') if content else False
@@ -487,25 +1439,18 @@ def generate_study_guide_from_uploads(uploads: List[Dict]) -> str:
             })
             print(f"  Processing text upload {i}: {title} ({len(content)} chars)")
     
-    # Combine text notes
-    notes_text = ""
-    for upload in text_uploads:
-        notes_text += f"\n--- Note {upload['index']}: {upload['title']} ---\n{upload['content']}\n"
-    
-    print(f"Total text content length: {len(notes_text)} chars")
-    print(f"Total image uploads: {len(image_uploads)}")
-    
-    # Check if we have any actual content
-    if len(notes_text.strip()) < 50 and len(image_uploads) == 0:
-        return "No content found in uploads. Please add some notes first."
-    
-    prompt = f"""You are an expert academic tutor and study-guide designer.
+    return text_uploads, image_uploads
 
-NOTES:
-{notes_text if notes_text.strip() else "No text notes provided."}
+
+# Fixed parts of the study guide prompt, built once at import time;
+# only the notes text is spliced in per request.
+# Static instructions come first and the notes last, so repeated runs for a
+# classroom (whose notes only grow at the end) share a long identical prefix
+# that providers with automatic prompt caching bill and process at a discount.
+STUDY_GUIDE_PROMPT_HEAD = """You are an expert academic tutor and study-guide designer.
 
 TASK:
-Create a comprehensive, cohesive study guide from these notes. Write it as a flowing, well-organized document that a student would actually want to read and study from — not a rigid template.
+Create a comprehensive, cohesive study guide from the notes below. Write it as a flowing, well-organized document that a student would actually want to read and study from — not a rigid template.
 
 OUTPUT FORMAT REQUIREMENTS:
 - Use clean, structured Markdown.
@@ -514,7 +1459,7 @@ OUTPUT FORMAT REQUIREMENTS:
   - Displayed equations: $$...$$
 - Preserve special symbols (∫, ∑, →, ≤, ≥, etc.) correctly.
 - Use headings, subheadings, bullet points, and spacing for readability.
-- If you need a literal dollar sign (currency or placeholder), escape it as \\\$ and do NOT wrap non-math words in $...$.
+- If you need a literal dollar sign (currency or placeholder), escape it as \\\\$ and do NOT wrap non-math words in $...$.
 
 GUIDELINES FOR CREATING THE STUDY GUIDE:
 
@@ -547,39 +1492,178 @@ STYLE GUIDELINES:
 - Use simple language without dumbing down technical content.
 - Create smooth transitions between sections.
 - Make it feel like a cohesive document, not a fill-in-the-blank template.
+
+NOTES:
 """
 
+STUDY_GUIDE_PROMPT_TAIL = """
+
+Now write the study guide for the notes above, following the guidelines.
+"""
+
+
+def build_study_guide_prompt(notes_text: str) -> str:
+    """Build the full study guide prompt around the combined notes text."""
+    if count_tokens(notes_text) > STUDY_GUIDE_MAX_INPUT_TOKENS:
+        print(f"Notes exceed {STUDY_GUIDE_MAX_INPUT_TOKENS} tokens; truncating")
+        notes_text = truncate_to_tokens(notes_text, STUDY_GUIDE_MAX_INPUT_TOKENS) + "\n\n[Additional notes truncated...]"
+    return "".join((
+        STUDY_GUIDE_PROMPT_HEAD,
+        notes_text if notes_text.strip() else "No text notes provided.",
+        STUDY_GUIDE_PROMPT_TAIL,
+    ))
+
+
+def generate_study_guide_from_uploads(uploads: List[Dict], on_text: Optional[TextCallback] = None) -> Optional[str]:
+    """
+    Generate a single comprehensive study guide from all uploads.
+    
+    Takes all uploaded notes and sends them to the LLM to create
+    one study guide organized by unit/topic. Very large note sets are
+    first condensed shard by shard (see `condense_notes_in_shards`).
+    Supports both text and image uploads (images are sent directly to vision models).
+    
+    Returns None if generation fails, so the error is never saved as the
+    guide (which would then count as current for these uploads).
+    """
+    text_uploads, image_uploads = _split_uploads(load_image_contents(uploads))
+    
+    # Combine text notes
+    notes_text = _format_notes(text_uploads)
+    
+    notes_tokens = count_tokens(notes_text)
+    print(f"Total text content length: {len(notes_text)} chars (~{notes_tokens} tokens)")
+    
+    # Large classrooms: condense the notes shard by shard (map) so the final
+    # study guide prompt (reduce) stays small instead of one huge call.
+    if notes_tokens > STUDY_GUIDE_MAP_REDUCE_TOKENS and len(text_uploads) > STUDY_GUIDE_SHARD_SIZE:
+        notes_text = condense_notes_in_shards(text_uploads)
+        print(f"Condensed text content length: {len(notes_text)} chars")
+    print(f"Total image uploads: {len(image_uploads)}")
+    
+    # Check if we have any actual content
+    if len(notes_text.strip()) < 50 and len(image_uploads) == 0:
+        return "No content found in uploads. Please add some notes first."
+    
+    prompt = build_study_guide_prompt(notes_text)
+
     print(f"Calling LLM with prompt length: {len(prompt)} chars")
     
     try:
         # If we have images, use vision-capable LLM call
         if image_uploads:
-            result = call_llm_with_images(prompt, image_uploads)
+            result = call_llm_with_images(prompt, image_uploads, on_text)
         else:
-            result = call_llm(prompt)
+            result = call_llm(prompt, on_text, study_guide_output_tokens(prompt))
         print(f"LLM returned {len(result) if result else 0} chars")
         
         if not result:
-            return "Study guide generation returned no response from AI. Please check API configuration."
+            print("Study guide generation returned no response from AI. Please check API configuration.")
+            return None
         
         if len(result.strip()) < 100:
             print(f"LLM response too short: {result}")
-            return f"Study guide generation returned insufficient content. Response: {result[:200]}"
+            return None
         
         return result
     except Exception as e:
         print(f"Error generating study guide: {e}")
-        import traceback
         traceback.print_exc()
-        return f"Study guide generation failed: {str(e)}"
+        return None
 
 
-def process_study_guide_only(classroom_id: str) -> Dict:
+def update_study_guide_with_uploads(existing_guide: str, new_uploads: List[Dict], on_text: Optional[TextCallback] = None) -> str:
+    """
+    Extend an existing study guide with newly added uploads.
+    
+    Only the new notes are sent alongside the previous guide, so adding one
+    upload to a large classroom costs O(new content) instead of re-reading
+    every note. Raises on failure so callers can fall back to a full
+    regeneration.
+    """
+    text_uploads, image_uploads = _split_uploads(load_image_contents(new_uploads))
+    notes_text = _format_notes(text_uploads)
+    
+    prompt = f"""You are an expert academic tutor maintaining a study guide for a class.
+
+EXISTING STUDY GUIDE:
+{existing_guide}
+
+NEW NOTES:
+{notes_text if notes_text.strip() else "No new text notes provided (see attached images)."}
+
+TASK:
+Update the existing study guide so it also covers the new notes (and any attached images).
+- Integrate new material into the matching topic/unit sections, or add new sections where needed.
+- Keep all existing content that is still accurate; do not drop sections.
+- Keep the same style: clean Markdown, LaTeX-style math ($...$ inline, $$...$$ displayed), worked examples, common pitfalls.
+- Make sure every new or changed section ends with 3-5 review questions (no answers).
+- If you need a literal dollar sign, escape it as \\\\$.
+
+Return the COMPLETE updated study guide, not just the changes.
+"""
+    
+    print(f"Calling LLM with update prompt length: {len(prompt)} chars")
+    if image_uploads:
+        result = call_llm_with_images(prompt, image_uploads, on_text)
+    else:
+        result = call_llm(prompt, on_text, study_guide_output_tokens(prompt))
+    
+    if not result or len(result.strip()) < 100:
+        raise Exception(f"Study guide update returned insufficient content: {(result or '')[:200]}")
+    return result
+
+
+def generate_or_update_study_guide(uploads: List[Dict], existing: Optional[Dict], force_regenerate: bool = False,
+                                   on_text: Optional[TextCallback] = None,
+                                   on_restart: Optional[Callable[[], None]] = None) -> Optional[str]:
+    """
+    Produce the study guide for a classroom, incrementally when possible.
+    
+    If an existing guide covers a subset of the current uploads (nothing was
+    deleted), only the new uploads are merged into it. Otherwise - or when
+    `force_regenerate` is set, or the merge fails - the guide is regenerated
+    from all uploads.
+    
+    `on_text` receives the guide's text as it streams in; `on_restart` is
+    called when a failed merge is discarded in favor of a full regeneration.
+    Returns None if the guide could not be generated.
+    """
+    processed_ids = _processed_ids_from_study_guide(existing)
+    current_ids = {u['id'] for u in uploads}
+    new_uploads = [u for u in uploads if u['id'] not in processed_ids]
+    
+    if not force_regenerate and processed_ids and processed_ids <= current_ids and new_uploads:
+        print(f"\nUpdating existing study guide with {len(new_uploads)} new uploads...")
+        try:
+            existing_content = get_insight_content(existing['id'])
+            if not existing_content:
+                raise Exception("Existing study guide has no content")
+            return update_study_guide_with_uploads(existing_content, new_uploads, on_text)
+        except Exception as e:
+            print(f"Incremental update failed, regenerating from all uploads: {e}")
+            if on_restart:
+                on_restart()
+    
+    print("\nGenerating study guide from all uploads...")
+    return generate_study_guide_from_uploads(uploads, on_text)
+
+
+def process_study_guide_only(classroom_id: str, force_regenerate: bool = False,
+                             on_text: Optional[TextCallback] = None,
+                             on_restart: Optional[Callable[[], None]] = None) -> Dict:
     """
     Generate only the study guide for a classroom (no insights).
     
+    This backs the teacher's explicit "Generate Study Guide" action, so it
+    always calls the LLM: with no new uploads the guide is regenerated.
+    
     Args:
         classroom_id: The classroom to process
+        force_regenerate: Rebuild from all uploads instead of merging only new ones
+        on_text: Receives the study guide text as it is generated
+        on_restart: Called when streamed text should be discarded (see
+            `generate_or_update_study_guide`)
         
     Returns:
         Dict with processing results
@@ -595,8 +1679,11 @@ def process_study_guide_only(classroom_id: str) -> Dict:
     print(f"Generating study guide for classroom: {classroom_id}")
     print(f"{'='*50}")
     
-    # Fetch all uploads
-    uploads = fetch_uploads(classroom_id)
+    # Fetch all uploads and the existing study guide together. The
+    # unchanged-uploads probe is skipped: an explicit request regenerates.
+    bundle = fetch_classroom_bundle(classroom_id, include_messages=False, force_regenerate=True)
+    uploads = bundle['uploads']
+    existing_guide = bundle['study_guide']
     print(f"\nFound {len(uploads)} total uploads")
     result['uploads_processed'] = len(uploads)
     
@@ -605,18 +1692,16 @@ def process_study_guide_only(classroom_id: str) -> Dict:
         print("No uploads to process.")
         return result
     
-    # Generate study guide from ALL uploads
-    print("\nGenerating study guide from all uploads...")
-    study_guide = generate_study_guide_from_uploads(uploads)
+    # Generate study guide (only new uploads are merged when possible)
+    study_guide = generate_or_update_study_guide(uploads, existing_guide, force_regenerate, on_text, on_restart)
+    if study_guide is None:
+        # Keep the previous guide; the next run retries the generation
+        result['success'] = False
+        result['error'] = 'Study guide generation failed; the existing study guide was kept.'
+        return result
     
     # Store/update the study guide
-    current_ids = [u['id'] for u in uploads]
-    metadata = {
-        'processed_upload_ids': current_ids,
-        'upload_count': len(uploads),
-        'last_updated': datetime.utcnow().isoformat()
-    }
-    update_or_create_study_guide(classroom_id, study_guide, metadata)
+    update_or_create_study_guide(classroom_id, study_guide, build_study_guide_metadata(uploads))
     
     result['message'] = f'Study guide generated from {len(uploads)} uploads.'
     
@@ -627,12 +1712,13 @@ def process_study_guide_only(classroom_id: str) -> Dict:
     return result
 
 
-def process_insights_only(classroom_id: str) -> Dict:
+def process_insights_only(classroom_id: str, force_regenerate: bool = False) -> Dict:
     """
     Generate only the confusion insights for a classroom (no study guide).
     
     Args:
         classroom_id: The classroom to process
+        force_regenerate: Reanalyze even if no messages arrived since the last run
         
     Returns:
         Dict with processing results
@@ -650,7 +1736,10 @@ def process_insights_only(classroom_id: str) -> Dict:
     
     # Analyze confusion patterns from chat
     print("\nAnalyzing confusion patterns...")
-    messages = fetch_messages(classroom_id)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        messages_future = executor.submit(fetch_messages, classroom_id)
+        existing_future = executor.submit(get_existing_confusion_summary, classroom_id)
+        messages, existing_summary = messages_future.result(), existing_future.result()
     print(f"Found {len(messages)} messages to analyze")
     result['messages_analyzed'] = len(messages)
     
@@ -659,27 +1748,21 @@ def process_insights_only(classroom_id: str) -> Dict:
         print("No messages to analyze.")
         return result
     
-    confusion_summary = analyze_confusion_patterns(messages)
+    # Skip the LLM when no messages arrived since the last analysis
+    if not force_regenerate and is_confusion_summary_current(existing_summary, messages):
+        mark_messages_seen(existing_summary, messages)
+        result['cached'] = True
+        result['message'] = 'Insights are up to date (no new messages).'
+        print("No new messages since last analysis, keeping existing insights.")
+        return result
     
-    # Check if confusion summary already exists
-    supabase = get_supabase()
-    existing_confusion = supabase.table('ai_insights').select('id').eq('classroom_id', classroom_id).eq('insight_type', 'confusion_summary').execute()
-    
-    if existing_confusion.data:
-        # Update existing
-        supabase.table('ai_insights').update({
-            'content': confusion_summary,
-            'metadata': {'message_count': len(messages)},
-            'created_at': datetime.utcnow().isoformat()
-        }).eq('id', existing_confusion.data[0]['id']).execute()
-        print("  ✓ Updated existing confusion summary")
-    else:
-        store_insight(
-            classroom_id=classroom_id,
-            insight_type='confusion_summary',
-            content=confusion_summary,
-            metadata={'message_count': len(messages)}
-        )
+    confusion_summary = analyze_confusion_patterns(messages)
+    if confusion_summary is None:
+        # Keep the previous summary; the next run retries the analysis
+        result['success'] = False
+        result['error'] = 'Confusion analysis failed; existing insights were kept.'
+        return result
+    update_or_create_confusion_summary(classroom_id, confusion_summary, messages)
     
     result['message'] = f'Insights generated from {len(messages)} messages.'
     
@@ -695,14 +1778,16 @@ def process_classroom(classroom_id: str, force_regenerate: bool = False) -> Dict
     Main processing function for a classroom (generates both study guide and insights).
     
     This orchestrates the entire AI pipeline:
-    1. Fetch all uploads from Supabase
-    2. Generate a SINGLE comprehensive study guide from all uploads
-    3. Analyze confusion patterns
-    4. Store results back to Supabase
+    1. Fetch uploads, messages and existing insights from Supabase (concurrently)
+    2. Generate a SINGLE comprehensive study guide (merging only new uploads
+       into the existing guide when possible) and analyze confusion patterns
+       (both LLM calls run concurrently)
+    3. Store results back to Supabase
     
     Args:
         classroom_id: The classroom to process
-        force_regenerate: Unused, kept for API compatibility
+        force_regenerate: Regenerate the study guide and insights even if the
+            uploads and messages are unchanged
         
     Returns:
         Dict with processing results
@@ -718,8 +1803,11 @@ def process_classroom(classroom_id: str, force_regenerate: bool = False) -> Dict
     print(f"Processing classroom: {classroom_id}")
     print(f"{'='*50}")
     
-    # Fetch all uploads
-    uploads = fetch_uploads(classroom_id)
+    # Fetch uploads, messages and existing insights in one concurrent batch
+    bundle = fetch_classroom_bundle(classroom_id, force_regenerate=force_regenerate)
+    uploads = bundle['uploads']
+    messages = bundle['messages']
+    existing_guide = bundle['study_guide']
     print(f"\nFound {len(uploads)} total uploads")
     result['uploads_processed'] = len(uploads)
     
@@ -728,46 +1816,57 @@ def process_classroom(classroom_id: str, force_regenerate: bool = False) -> Dict
         print("No uploads to process.")
         return result
     
-    # Generate study guide from ALL uploads
-    print("\nGenerating study guide from all uploads...")
-    study_guide = generate_study_guide_from_uploads(uploads)
-    
-    # Store/update the study guide
-    current_ids = [u['id'] for u in uploads]
-    metadata = {
-        'processed_upload_ids': current_ids,
-        'upload_count': len(uploads),
-        'last_updated': datetime.utcnow().isoformat()
-    }
-    update_or_create_study_guide(classroom_id, study_guide, metadata)
-    
-    result['message'] = f'Study guide generated from {len(uploads)} uploads.'
-    
-    # Analyze confusion patterns from chat (optional)
-    print("\nAnalyzing confusion patterns...")
-    messages = fetch_messages(classroom_id)
     print(f"Found {len(messages)} messages to analyze")
     
-    if messages:
-        confusion_summary = analyze_confusion_patterns(messages)
-        # Check if confusion summary already exists
-        supabase = get_supabase()
-        existing_confusion = supabase.table('ai_insights').select('id').eq('classroom_id', classroom_id).eq('insight_type', 'confusion_summary').execute()
-        
-        if existing_confusion.data:
-            # Update existing
-            supabase.table('ai_insights').update({
-                'content': confusion_summary,
-                'metadata': {'message_count': len(messages)},
-                'created_at': datetime.utcnow().isoformat()
-            }).eq('id', existing_confusion.data[0]['id']).execute()
-        else:
-            store_insight(
-                classroom_id=classroom_id,
-                insight_type='confusion_summary',
-                content=confusion_summary,
-                metadata={'message_count': len(messages)}
-            )
+    # Skip the study guide LLM call when the uploads are unchanged since the last run
+    study_guide_cached = bundle['uploads_unchanged']
+    # Likewise skip the confusion analysis when no messages arrived since the last run
+    insights_cached = not force_regenerate and is_confusion_summary_current(bundle['confusion_summary'], messages)
+    if insights_cached:
+        mark_messages_seen(bundle['confusion_summary'], messages)
+        result['insights_cached'] = True
+        print("No new messages since last analysis, keeping existing insights.")
+    
+    # The study guide and confusion analysis are independent LLM calls that
+    # spend nearly all their time waiting on the provider, so run them
+    # side by side instead of back-to-back.
+    print("\nGenerating study guide and analyzing confusion patterns...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        study_guide_future = None if study_guide_cached else executor.submit(
+            generate_or_update_study_guide, uploads, existing_guide, force_regenerate
+        )
+        confusion_future = executor.submit(analyze_confusion_patterns, messages) if messages and not insights_cached else None
+        study_guide = study_guide_future.result() if study_guide_future else None
+        confusion_summary = confusion_future.result() if confusion_future else None
+    
+    # Both insights are saved with a single upsert
+    rows = []
+    if study_guide_cached:
+        result['cached'] = True
+        result['message'] = f'Study guide is up to date ({len(uploads)} uploads unchanged).'
+        print("Uploads unchanged since last generation, reused existing study guide.")
+    elif study_guide is None:
+        # Keep the previous guide; the next run retries the generation
+        result['success'] = False
+        result['error'] = 'Study guide generation failed; the existing study guide was kept.'
+    else:
+        rows.append(_insight_row(
+            classroom_id, 'study_guide', study_guide, STUDY_GUIDE_UNIT_NAME,
+            build_study_guide_metadata(uploads)
+        ))
+        result['message'] = f'Study guide generated from {len(uploads)} uploads.'
+    
+    # Store confusion patterns from chat (optional). A failed analysis
+    # returns None and keeps the previous summary, so the next run retries.
+    if confusion_future and confusion_summary is None:
+        result['insights_failed'] = True
+    if confusion_summary is not None:
+        rows.append(_insight_row(
+            classroom_id, 'confusion_summary', confusion_summary,
+            metadata=build_confusion_metadata(messages)
+        ))
+    
+    upsert_insights(rows)
     
     print(f"\n{'='*50}")
     print("Processing complete!")
@@ -776,80 +1875,745 @@ def process_classroom(classroom_id: str, force_regenerate: bool = False) -> Dict
     return result
 
 
-def process_all_classrooms():
-    """Process all classrooms in the database."""
+def process_classrooms(classroom_ids: List[str], force_regenerate: bool = False) -> List[Dict]:
+    """
+    Process several classrooms, MAX_CONCURRENT_CLASSROOMS at a time.
+    
+    Returns one result per classroom, in the same order as `classroom_ids`.
+    A failing classroom gets a `success: False` result instead of aborting the rest.
+    """
+    def process_one(classroom_id: str) -> Dict:
+        try:
+            return process_classroom(classroom_id, force_regenerate=force_regenerate)
+        except Exception as e:
+            print(f"Error processing classroom {classroom_id}: {e}")
+            return {'success': False, 'classroom_id': classroom_id, 'error': str(e)}
+    
+    # Classrooms are independent and network-bound, so process several at once
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CLASSROOMS) as executor:
+        return list(executor.map(process_one, classroom_ids))
+
+
+def fetch_classrooms_needing_refresh() -> Optional[set]:
+    """
+    IDs of classrooms with new uploads or messages since their last AI run.
+    
+    Answered by one database call (see supabase-upgrade.sql), so bulk runs
+    skip idle classrooms without loading their notes. Returns None when the
+    function isn't installed, in which case every classroom should be checked.
+    """
+    try:
+        rows = get_supabase().rpc('classrooms_needing_ai_refresh').execute().data or []
+    except Exception as e:
+        print(f"Warning: can't list active classrooms, checking all of them (run supabase-upgrade.sql): {e}")
+        return None
+    return {row['classroom_id'] for row in rows}
+
+
+def process_all_classrooms() -> List[Dict]:
+    """Process all classrooms with new activity (MAX_CONCURRENT_CLASSROOMS at a time)."""
     supabase = get_supabase()
     response = supabase.table('classrooms').select('id, name').execute()
     classrooms = response.data or []
     
-    print(f"Found {len(classrooms)} classrooms to process")
+    print(f"Found {len(classrooms)} classrooms")
+    active = fetch_classrooms_needing_refresh()
+    if active is not None:
+        classrooms = [c for c in classrooms if c['id'] in active]
+        print(f"{len(classrooms)} have new uploads or messages; skipping the rest")
+    
+    return process_classrooms([c['id'] for c in classrooms])
+
+
+# ============================================================
+# Bulk Processing via the OpenAI Batch API
+# ============================================================
+# Nightly/bulk regenerations are not latency-sensitive, so their prompts can
+# go through the Batch API: ~50% cheaper and not bound by realtime rate limits.
+
+BATCH_POLL_INTERVAL = int(os.getenv('AI_BATCH_POLL_INTERVAL', '30'))
+
+
+def submit_openai_batch(prompts: List[Tuple[str, str, Optional[int]]]) -> str:
+    """
+    Submit `(custom_id, prompt, max_tokens)` requests as one OpenAI batch job.
+    
+    Returns:
+        The batch ID
+    """
+    client = get_openai_client()
+    lines = []
+    for custom_id, prompt, max_tokens in prompts:
+        body = {
+            "model": OPENAI_MODEL,
+            "messages": [
+                {"role": "system", "content": OPENAI_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        }
+        if max_tokens:
+            body["max_completion_tokens"] = max_tokens
+        lines.append(json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": body
+        }))
+    
+    batch_file = client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+        purpose="batch"
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    print(f"Submitted batch {batch.id} with {len(prompts)} requests")
+    return batch.id
+
+
+def wait_for_openai_batch(batch_id: str) -> Dict[str, str]:
+    """
+    Poll an OpenAI batch until it finishes and return its results.
+    
+    An expired or cancelled batch still returns the requests it completed.
     
-    for classroom in classrooms:
-        process_classroom(classroom['id'])
+    Returns:
+        Dict mapping custom_id to the generated text (failed requests are omitted)
+    """
+    client = get_openai_client()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        print(f"  Batch {batch_id}: {batch.status}" + (f" ({counts.completed}/{counts.total})" if counts else ""))
+        if batch.status in ('completed', 'failed', 'expired', 'cancelled'):
+            break
+        time.sleep(BATCH_POLL_INTERVAL)
+    
+    if not batch.output_file_id:
+        raise Exception(f"Batch {batch_id} ended with status '{batch.status}'")
+    
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        response = item.get('response') or {}
+        if response.get('status_code') != 200:
+            print(f"  Batch request {item.get('custom_id')} failed: {item.get('error')}")
+            continue
+        results[item['custom_id']] = response['body']['choices'][0]['message']['content'] or ""
+    return results
+
+
+def process_all_classrooms_batch() -> List[Dict]:
+    """
+    Regenerate study guides and confusion summaries for every classroom
+    through the OpenAI Batch API.
+    
+    Classrooms whose uploads are unchanged are skipped. Classrooms that need
+    the vision model or the map-reduce pass (images or very large notes) are
+    processed live. All batch results are saved with a single bulk upsert.
+    Falls back to `process_all_classrooms` for providers without batch support.
+    """
+    if AI_PROVIDER != 'openai':
+        print(f"Batch mode is only supported with OpenAI; processing live with {get_ai_provider_info()}")
+        return process_all_classrooms()
+    
+    supabase = get_supabase()
+    classrooms = supabase.table('classrooms').select('id, name').execute().data or []
+    active = fetch_classrooms_needing_refresh()
+    if active is not None:
+        classrooms = [c for c in classrooms if c['id'] in active]
+    print(f"Found {len(classrooms)} classrooms to process in batch mode")
+    
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_CLASSROOMS) as executor:
+        bundles = dict(zip(
+            [c['id'] for c in classrooms],
+            executor.map(fetch_classroom_bundle, [c['id'] for c in classrooms])
+        ))
+    
+    prompts = []
+    pending = {}
+    live_ids = []
+    results = []
+    for classroom_id, bundle in bundles.items():
+        uploads, messages = bundle['uploads'], bundle['messages']
+        if not uploads:
+            results.append({'success': True, 'classroom_id': classroom_id, 'message': 'No uploads found in this classroom.'})
+            continue
+        
+        # Notes are only formatted and tokenized for classrooms whose study
+        # guide is out of date; current ones just need their confusion summary
+        if not bundle['uploads_unchanged']:
+            text_uploads, image_uploads = _split_uploads(uploads)
+            notes_text = _format_notes(text_uploads)
+            if image_uploads or count_tokens(notes_text) > STUDY_GUIDE_MAP_REDUCE_TOKENS:
+                live_ids.append(classroom_id)
+                continue
+            if len(notes_text.strip()) >= 50:
+                prompt = build_study_guide_prompt(notes_text)
+                prompts.append((f"{classroom_id}:study_guide", prompt, study_guide_output_tokens(prompt)))
+        
+        if is_confusion_summary_current(bundle['confusion_summary'], messages):
+            mark_messages_seen(bundle['confusion_summary'], messages)
+            confusion_prompt = None
+        else:
+            confusion_prompt = build_confusion_prompt(messages)
+        if confusion_prompt:
+            prompts.append((f"{classroom_id}:confusion_summary", confusion_prompt, CONFUSION_MAX_OUTPUT_TOKENS))
+        
+        pending[classroom_id] = (uploads, messages)
+    
+    outputs = wait_for_openai_batch(submit_openai_batch(prompts)) if prompts else {}
+    
+    # Requests that failed or expired inside the batch are finished live below;
+    # whatever did complete is saved first, so the live run reuses it
+    missing = {custom_id.rsplit(':', 1)[0] for custom_id, *_ in prompts if custom_id not in outputs}
+    if missing:
+        print(f"  {len(missing)} classrooms incomplete in batch, processing them live")
+    
+    rows = []
+    for classroom_id, (uploads, messages) in pending.items():
+        study_guide = outputs.get(f"{classroom_id}:study_guide")
+        if study_guide:
+            rows.append(_insight_row(
+                classroom_id, 'study_guide', study_guide, STUDY_GUIDE_UNIT_NAME,
+                build_study_guide_metadata(uploads)
+            ))
+        confusion_summary = outputs.get(f"{classroom_id}:confusion_summary")
+        if confusion_summary:
+            rows.append(_insight_row(
+                classroom_id, 'confusion_summary', confusion_summary,
+                metadata=build_confusion_metadata(messages)
+            ))
+        if classroom_id in missing:
+            live_ids.append(classroom_id)
+        else:
+            results.append({'success': True, 'classroom_id': classroom_id, 'uploads_processed': len(uploads), 'message': 'Processed via batch.'})
+    
+    if rows:
+        upsert_insights(rows)
+        print(f"  ✓ Saved {len(rows)} insights from batch")
+    
+    # Classrooms that need the vision model or map-reduce run live, in parallel
+    results.extend(process_classrooms(live_ids))
+    
+    return results
+
+
+# ============================================================
+# Background Jobs
+# ============================================================
+# /generate can run the pipeline in the background and return a job ID
+# immediately. With REDIS_URL set (and `rq` installed) jobs go to an RQ queue
+# shared by every server process and run by `python app.py --worker` (or
+# `rq worker classly-ai`); otherwise they run on an in-process thread pool
+# (single-process/dev deployments).
+
+JOB_QUEUE_NAME = 'classly-ai'
+JOB_WORKERS = int(os.getenv('AI_JOB_WORKERS', '4'))
+JOB_RESULT_TTL = int(os.getenv('AI_JOB_RESULT_TTL', '3600'))
+
+_job_queue = None
+def get_job_queue():
+    """Get the RQ queue, or None when no Redis is configured."""
+    global _job_queue
+    if _job_queue is None and REDIS_URL:
+        with _clients_lock:
+            if _job_queue is None:
+                from rq import Queue
+                _job_queue = Queue(JOB_QUEUE_NAME, connection=get_redis())
+    return _job_queue
+
+
+_job_executor = None
+_jobs: Dict[str, Dict] = {}
+_jobs_lock = threading.Lock()
+
+def _get_job_executor() -> ThreadPoolExecutor:
+    global _job_executor
+    if _job_executor is None:
+        with _clients_lock:
+            if _job_executor is None:
+                _job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='classly-job')
+    return _job_executor
+
+
+def _run_local_job(job_id: str, classroom_id: str, force_regenerate: bool):
+    with _jobs_lock:
+        _jobs[job_id]['status'] = 'running'
+    try:
+        result = process_classroom(classroom_id, force_regenerate=force_regenerate)
+        update = {'status': 'finished', 'result': result}
+    except Exception as e:
+        traceback.print_exc()
+        update = {'status': 'failed', 'error': str(e)}
+    with _jobs_lock:
+        _jobs[job_id].update(update, finished_at=time.time())
+
+
+# Deletes a Redis key only while it still holds the given value
+_RELEASE_CLAIM_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def enqueue_classroom_job(classroom_id: str, force_regenerate: bool = False) -> str:
+    """
+    Queue `process_classroom` to run in the background.
+    
+    If the same classroom is already queued or running with the same
+    `force_regenerate`, its existing job ID is returned instead of queueing
+    a duplicate run.
+    
+    Returns:
+        The job ID to poll with `get_job_status`
+    """
+    force_regenerate = bool(force_regenerate)
+    job_queue = get_job_queue()
+    if job_queue is not None:
+        redis = job_queue.connection
+        active_key = f"{JOB_QUEUE_NAME}:active:{classroom_id}:{int(force_regenerate)}"
+        job_id = uuid.uuid4().hex
+        # Claim the classroom atomically so concurrent requests can't both enqueue
+        while not redis.set(active_key, job_id, nx=True, ex=SERVER_TIMEOUT * 5):
+            active_id = redis.get(active_key)
+            if active_id is None:
+                continue  # The claim just expired; try again
+            active_id = active_id.decode('utf-8')
+            status = get_job_status(active_id)
+            # No status yet: the claiming request is still enqueueing it
+            if status is None or status['status'] in ('queued', 'running'):
+                return active_id
+            # The claimed job already finished; drop the claim unless another
+            # request replaced it meanwhile
+            redis.eval(_RELEASE_CLAIM_SCRIPT, 1, active_key, active_id)
+        
+        try:
+            # Referenced by import path so `rq worker` can load it
+            job_queue.enqueue(
+                'app.process_classroom', classroom_id, force_regenerate=force_regenerate,
+                job_id=job_id, job_timeout=SERVER_TIMEOUT * 5,
+                result_ttl=JOB_RESULT_TTL, failure_ttl=JOB_RESULT_TTL
+            )
+        except BaseException:
+            redis.eval(_RELEASE_CLAIM_SCRIPT, 1, active_key, job_id)
+            raise
+        return job_id
+    
+    now = time.time()
+    with _jobs_lock:
+        for job in _jobs.values():
+            if (job['classroom_id'] == classroom_id and job['force_regenerate'] == force_regenerate
+                    and job['status'] in ('queued', 'running')):
+                return job['job_id']
+        
+        # Forget finished jobs older than JOB_RESULT_TTL
+        for stale_id in [j for j, job in _jobs.items() if now - job.get('finished_at', now) > JOB_RESULT_TTL]:
+            del _jobs[stale_id]
+        job_id = uuid.uuid4().hex
+        _jobs[job_id] = {
+            'job_id': job_id,
+            'classroom_id': classroom_id,
+            'force_regenerate': force_regenerate,
+            'status': 'queued'
+        }
+    _get_job_executor().submit(_run_local_job, job_id, classroom_id, force_regenerate)
+    return job_id
+
+
+def get_job_status(job_id: str) -> Optional[Dict]:
+    """Get a background job's status (queued, running, finished or failed) and result."""
+    job_queue = get_job_queue()
+    if job_queue is not None:
+        from rq.job import Job
+        from rq.exceptions import NoSuchJobError
+        try:
+            job = Job.fetch(job_id, connection=job_queue.connection)
+        except NoSuchJobError:
+            return None
+        status = job.get_status(refresh=False)
+        status = getattr(status, 'value', status)
+        status = {'started': 'running', 'deferred': 'queued', 'scheduled': 'queued'}.get(status, status)
+        info = {'job_id': job_id, 'status': status}
+        if status == 'finished':
+            info['result'] = job.return_value()
+        elif status in ('failed', 'stopped', 'canceled'):
+            info['status'] = 'failed'
+            # Last traceback line holds the exception message
+            lines = (job.exc_info or '').strip().splitlines()
+            info['error'] = lines[-1] if lines else 'Job failed'
+        return info
+    
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return {k: v for k, v in job.items() if k != 'finished_at'} if job else None
+
+
+def _reset_clients_after_fork():
+    """
+    Drop network clients and thread pools inherited from a parent process.
+    
+    Clients are created lazily and reused for the life of a process, but a
+    forked child (gunicorn worker, RQ work horse) must not share the
+    parent's pooled sockets, and executor threads don't survive a fork.
+    The child recreates each one on first use.
+    
+    Every lock is replaced as well: a thread that held one at fork time
+    does not exist in the child, so it would never be released there.
+    """
+    global _supabase, _redis, _gemini_model, _openai_client, _job_queue, _job_executor, _stream_executor, _clients_lock
+    global _disk_llm_cache, _disk_llm_cache_lock, _local_llm_cache_lock, _jobs_lock, _inflight_lock, _llm_call_slots
+    _supabase = _redis = _gemini_model = _openai_client = _job_queue = _job_executor = _stream_executor = None
+    # SQLite connections must not be used across a fork either
+    _disk_llm_cache = None
+    _disk_llm_cache_lock = threading.Lock()
+    _clients_lock = threading.RLock()
+    _local_llm_cache_lock = threading.Lock()
+    _llm_call_slots = threading.BoundedSemaphore(LLM_MAX_CONCURRENT_CALLS) if LLM_MAX_CONCURRENT_CALLS > 0 else nullcontext()
+    for limiter in (_llm_request_bucket, _llm_token_bucket, *_provider_breakers.values()):
+        limiter._lock = threading.Lock()
+    # Jobs and coalesced runs belong to the parent's threads, which are gone
+    _jobs.clear()
+    _jobs_lock = threading.Lock()
+    _inflight.clear()
+    _inflight_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_clients_after_fork)
+
+
+def run_job_worker():
+    """
+    Run queued background jobs in this process until interrupted.
+    
+    `rq worker` forks a fresh work horse for every job, so each job re-opens
+    its Supabase, Redis and AI provider connections. Here jobs run one after
+    another in this process and reuse the same warm clients; start several
+    workers to run jobs in parallel.
+    """
+    job_queue = get_job_queue()
+    if job_queue is None:
+        print("Error: REDIS_URL must be set to run a job worker")
+        sys.exit(1)
+    
+    from rq import SimpleWorker
+    
+    # Jobs reference 'app.process_classroom'; when started as a script this
+    # module is __main__, so point 'app' at it instead of importing it twice
+    sys.modules.setdefault('app', sys.modules[__name__])
+    print(f"Worker listening on queue '{JOB_QUEUE_NAME}'")
+    SimpleWorker([job_queue], connection=job_queue.connection).work()
+
+
+_inflight: Dict[Tuple, Future] = {}
+_inflight_lock = threading.Lock()
+
+def run_coalesced(key: Tuple, fn, *args, **kwargs):
+    """
+    Run `fn(*args, **kwargs)` once per `key` at a time.
+    
+    Callers that arrive with the same key while it is running (double
+    clicks, client retries, two teachers on one classroom) wait for and
+    share the first caller's result instead of repeating the LLM calls.
+    They wait as long as the first caller does: its LLM calls are already
+    bounded by LLM_TIMEOUT, so no second, shorter deadline is applied.
+    """
+    with _inflight_lock:
+        future = _inflight.get(key)
+        owner = future is None
+        if owner:
+            future = _inflight[key] = Future()
+    
+    if not owner:
+        return future.result()
+    
+    try:
+        result = fn(*args, **kwargs)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
 
 
 # ============================================================
 # HTTP Server for Frontend Integration
 # ============================================================
 
+# Request bodies only carry IDs and flags; anything bigger is rejected
+# before it is read or parsed
+MAX_REQUEST_BYTES = 16 * 1024
+CLASSROOM_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+SSE_HEARTBEAT_INTERVAL = 15  # Seconds of silence before a stream sends a keep-alive comment
+# Streamed generations get their own pool so they never wait behind /generate jobs
+SSE_STREAM_WORKERS = int(os.getenv('AI_SSE_STREAM_WORKERS', '4'))
+
+_stream_executor = None
+
+def _get_stream_executor() -> ThreadPoolExecutor:
+    global _stream_executor
+    if _stream_executor is None:
+        with _clients_lock:
+            if _stream_executor is None:
+                _stream_executor = ThreadPoolExecutor(max_workers=SSE_STREAM_WORKERS, thread_name_prefix='classly-stream')
+    return _stream_executor
+
+
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    # Let browsers cache the preflight instead of repeating it before every POST
+    'Access-Control-Max-Age': '86400',
+}
+
+
+def classroom_id_error(classroom_id) -> Optional[str]:
+    """Validate a classroom ID from a request body; returns an error message or None."""
+    if not classroom_id:
+        return 'classroom_id is required'
+    if not isinstance(classroom_id, str) or not CLASSROOM_ID_PATTERN.fullmatch(classroom_id):
+        return 'classroom_id is invalid'
+    return None
+
+
+def read_json_body() -> Dict:
+    """The request's JSON object, or {} for a missing or malformed body."""
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+
+def health_check_middleware(wsgi_app, body: bytes):
+    """
+    Answer GET/HEAD /health directly at the WSGI layer.
+    
+    Health probes are the most frequent request and need none of Flask's
+    routing, request parsing or hooks, so they skip the framework entirely.
+    """
+    headers = [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(body))),
+        *CORS_HEADERS.items(),
+    ]
+
+    def middleware(environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if environ.get('PATH_INFO') == '/health' and method in ('GET', 'HEAD'):
+            start_response('200 OK', headers)
+            return [body] if method == 'GET' else []
+        return wsgi_app(environ, start_response)
+
+    return middleware
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize `jsonify` responses with orjson."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand orjson's bytes straight to the response instead of decoding
+        # them to str and having Werkzeug encode them again (study guides
+        # make these bodies tens of KB)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=orjson.OPT_APPEND_NEWLINE)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
 def create_app():
     """Create the Flask app (WSGI entrypoint for serverless)."""
-    from flask import Flask, request, jsonify
-    from flask_cors import CORS
-
     app = Flask(__name__)
-    CORS(app)  # Enable CORS for frontend requests
-
-    @app.route('/health', methods=['GET'])
-    def health():
-        return jsonify({
-            'status': 'ok',
-            'provider': AI_PROVIDER,
-            'model': GEMINI_MODEL if AI_PROVIDER == 'gemini' else OPENAI_MODEL
-        })
+    app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+
+    # Enable CORS for frontend requests. The API is public and uses no
+    # cookies, so constant headers are enough; preflight OPTIONS requests
+    # are answered by Flask's automatic OPTIONS handling.
+    @app.after_request
+    def add_cors_headers(response):
+        response.headers.update(CORS_HEADERS)
+        return response
+
+    @app.errorhandler(413)
+    def request_too_large(e):
+        return jsonify({'success': False, 'error': 'Request body too large'}), 413
+
+    # The health payload never changes while the process runs, so
+    # serialize it once instead of on every liveness probe
+    health_body = app.json.dumps({
+        'status': 'ok',
+        'provider': AI_PROVIDER,
+        'model': GEMINI_MODEL if AI_PROVIDER == 'gemini' else OPENAI_MODEL
+    })
+    app.wsgi_app = health_check_middleware(app.wsgi_app, health_body.encode('utf-8'))
 
     @app.route('/generate', methods=['POST'])
     def generate():
         """Generate both study guide and insights for a classroom (legacy endpoint)."""
+        # Read outside the try so an oversized body surfaces as a 413
+        data = read_json_body()
         try:
-            data = request.get_json()
             classroom_id = data.get('classroom_id')
+            classroom_ids = data.get('classroom_ids')
             force = data.get('force', False)
 
-            if not classroom_id:
-                return jsonify({'success': False, 'error': 'classroom_id is required'}), 400
-
-            result = process_classroom(classroom_id, force_regenerate=force)
+            # {"classroom_ids": [...]}: queue one background job per classroom
+            # (a synchronous run of many classrooms would outlast SERVER_TIMEOUT)
+            if classroom_ids is not None:
+                if not isinstance(classroom_ids, list) or not classroom_ids:
+                    return jsonify({'success': False, 'error': 'classroom_ids must be a non-empty list'}), 400
+                error = next(filter(None, map(classroom_id_error, classroom_ids)), None)
+                if error:
+                    return jsonify({'success': False, 'error': error}), 400
+                jobs = []
+                for batch_classroom_id in classroom_ids:
+                    job_id = enqueue_classroom_job(batch_classroom_id, force_regenerate=force)
+                    jobs.append({
+                        'classroom_id': batch_classroom_id,
+                        'job_id': job_id,
+                        'status_url': f'/status/{job_id}'
+                    })
+                return jsonify({'success': True, 'status': 'queued', 'jobs': jobs}), 202
+
+            error = classroom_id_error(classroom_id)
+            if error:
+                return jsonify({'success': False, 'error': error}), 400
+
+            # {"async": true}: run in the background and return a job ID to poll
+            if data.get('async', False):
+                job_id = enqueue_classroom_job(classroom_id, force_regenerate=force)
+                return jsonify({
+                    'success': True,
+                    'job_id': job_id,
+                    'status': 'queued',
+                    'status_url': f'/status/{job_id}'
+                }), 202
+
+            result = run_coalesced(('generate', classroom_id, bool(force)), process_classroom, classroom_id, force_regenerate=force)
             return jsonify(result)
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 500
 
+    @app.route('/status/<job_id>', methods=['GET'])
+    @app.route('/generate/<job_id>', methods=['GET'])
+    def job_status(job_id):
+        """Get the status (and result, once finished) of a background /generate job."""
+        try:
+            status = get_job_status(job_id)
+            if status is None:
+                return jsonify({'success': False, 'error': 'Job not found'}), 404
+            return jsonify({'success': status['status'] != 'failed', **status})
+        except Exception as e:
+            return jsonify({'success': False, 'error': str(e)}), 500
+
     @app.route('/generate-study-guide', methods=['POST'])
     def generate_study_guide_endpoint():
         """Generate only the study guide for a classroom (no insights)."""
+        data = read_json_body()
         try:
-            data = request.get_json()
             classroom_id = data.get('classroom_id')
+            force = data.get('force', False)
 
-            if not classroom_id:
-                return jsonify({'success': False, 'error': 'classroom_id is required'}), 400
+            error = classroom_id_error(classroom_id)
+            if error:
+                return jsonify({'success': False, 'error': error}), 400
 
-            result = process_study_guide_only(classroom_id)
+            result = run_coalesced(('study_guide', classroom_id, bool(force)), process_study_guide_only, classroom_id, force_regenerate=force)
             return jsonify(result)
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 500
 
+    @app.route('/generate-study-guide/stream', methods=['POST'])
+    def stream_study_guide_endpoint():
+        """
+        Generate the study guide and stream it as Server-Sent Events.
+        
+        Events: `token` ({"text": ...}) for each chunk of the guide as the
+        LLM writes it, `reset` when the text so far should be discarded (a
+        failed incremental merge is being regenerated), then either `done`
+        (the same result as /generate-study-guide) or `error`.
+        
+        Runs are coalesced with /generate-study-guide for the same classroom:
+        a request that joins a generation already in progress receives only
+        its `done` (or `error`) event.
+        """
+        data = read_json_body()
+        classroom_id = data.get('classroom_id')
+        force = data.get('force', False)
+
+        error = classroom_id_error(classroom_id)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+
+        events = queue.Queue()
+
+        def run():
+            try:
+                result = run_coalesced(
+                    ('study_guide', classroom_id, bool(force)), process_study_guide_only,
+                    classroom_id, force_regenerate=force,
+                    on_text=lambda text: events.put(('token', {'text': text})),
+                    on_restart=lambda: events.put(('reset', {}))
+                )
+                events.put(('done', result))
+            except Exception as e:
+                traceback.print_exc()
+                events.put(('error', {'success': False, 'error': str(e)}))
+            finally:
+                events.put(None)
+
+        # Generation runs on the stream pool so tokens can be flushed to the
+        # client while the LLM is still writing
+        _get_stream_executor().submit(run)
+
+        def stream():
+            # Headers go out with the first chunk, so send a comment right
+            # away instead of after the data fetch and the LLM's first token
+            yield ": stream open\n\n"
+            while True:
+                try:
+                    item = events.get(timeout=SSE_HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    # Keep proxies from closing a connection that is still
+                    # waiting on a slow provider
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    break
+                event, payload = item
+                yield f"event: {event}\ndata: {app.json.dumps(payload)}\n\n"
+
+        return Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
     @app.route('/generate-insights', methods=['POST'])
     def generate_insights_endpoint():
         """Generate only the confusion insights for a classroom (no study guide)."""
+        data = read_json_body()
         try:
-            data = request.get_json()
             classroom_id = data.get('classroom_id')
+            force = data.get('force', False)
 
-            if not classroom_id:
-                return jsonify({'success': False, 'error': 'classroom_id is required'}), 400
+            error = classroom_id_error(classroom_id)
+            if error:
+                return jsonify({'success': False, 'error': error}), 400
 
-            result = process_insights_only(classroom_id)
+            result = run_coalesced(('insights', classroom_id, bool(force)), process_insights_only, classroom_id, force_regenerate=force)
             return jsonify(result)
         except Exception as e:
             return jsonify({'success': False, 'error': str(e)}), 500
@@ -861,9 +2625,31 @@ def create_app():
 app = create_app()
 
 
-def run_server():
-    """Run the AI service as an HTTP server."""
-    provider_info = get_ai_provider_info()
+def warm_up_clients():
+    """
+    Create the Supabase, Redis and AI provider clients ahead of the first request.
+    
+    Their SDKs are imported lazily, so otherwise the first request of each
+    worker pays for the imports and client setup. The tokenizer vocabulary
+    is loaded here too (downloaded once, then read from TIKTOKEN_CACHE_DIR).
+    """
+    _get_token_encoder()
+    llm_client = get_gemini_model if AI_PROVIDER == 'gemini' else get_openai_client
+    for getter in (get_supabase, get_redis, llm_client):
+        try:
+            getter()
+        except Exception as e:
+            print(f"Warning: {getter.__name__} failed during warm-up: {e}")
+
+
+def run_server(provider_info: Optional[str] = None):
+    """
+    Run the AI service as an HTTP server.
+    
+    The banner is printed once by the gunicorn master before it forks, so
+    workers inherit the app without repeating any startup output.
+    """
+    provider_info = provider_info or get_ai_provider_info()
     print(f"""
 ╔═══════════════════════════════════════════════════════════════╗
 ║              Classly AI Service (HTTP Server)                 ║
@@ -873,14 +2659,61 @@ def run_server():
 ║  Endpoints:                                                   ║
 ║    GET  /health              - Health check                   ║
 ║    POST /generate            - Generate both (legacy)         ║
+║    GET  /status/<job_id>     - Background job status          ║
 ║    POST /generate-study-guide - Study guide only              ║
+║    POST /generate-study-guide/stream - Study guide via SSE    ║
 ║    POST /generate-insights    - Confusion insights only       ║
 ║                                                               ║
 ║  Server running on port {SERVER_PORT}                              ║
 ╚═══════════════════════════════════════════════════════════════╝
     """)
 
-    app.run(host='0.0.0.0', port=SERVER_PORT, debug=False)
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        # gunicorn is unavailable on Windows; fall back to Flask's threaded server
+        print("gunicorn not available, using Flask's built-in server")
+        warm_up_clients()
+        app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, threaded=True)
+        return
+
+    class GunicornServer(BaseApplication):
+        """Embed gunicorn so `python app.py` runs the production server."""
+
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    # Import the SDKs once in the master so workers inherit them; the clients
+    # themselves are dropped at fork and rebuilt in each worker before it
+    # accepts requests
+    warm_up_clients()
+    GunicornServer(app, {
+        'bind': f'0.0.0.0:{SERVER_PORT}',
+        'workers': SERVER_WORKERS,
+        'worker_class': SERVER_WORKER_CLASS,
+        'threads': SERVER_THREADS,
+        'worker_connections': SERVER_WORKER_CONNECTIONS,
+        'timeout': SERVER_TIMEOUT,
+        'keepalive': SERVER_KEEPALIVE,
+        # The app is imported once here and forked into the workers, which
+        # share the loaded modules copy-on-write. Network clients (Supabase,
+        # LLM SDKs, Redis) are lazy, so each worker opens its own sockets.
+        'preload_app': True,
+        # SO_REUSEPORT: several server instances (e.g. one per CPU set, or old
+        # and new during a redeploy) can bind the same port and the kernel
+        # balances connections between their accept queues
+        'reuse_port': True,
+        'post_worker_init': lambda worker: warm_up_clients(),
+    }).run()
 
 
 def main():
@@ -902,19 +2735,35 @@ def main():
 ║  Individual student messages are never exposed.               ║
 ╚═══════════════════════════════════════════════════════════════╝
     """)
-    run_server()
-    # if len(sys.argv) > 1:
-    #     if sys.argv[1] == '--server':
-    #         # Run as HTTP server
-    #         run_server()
-    #     else:
-    #         # Process specific classroom
-    #         classroom_id = sys.argv[1]
-    #         process_classroom(classroom_id)
-    # else:
-    #     # Process all classrooms
-    #     print("No classroom ID provided. Processing all classrooms...")
-    #     process_all_classrooms()
+    if len(sys.argv) > 1:
+        if sys.argv[1] == '--server':
+            # Run as HTTP server (gunicorn)
+            run_server(provider_info)
+        elif sys.argv[1] == '--batch':
+            # Process all classrooms through the OpenAI Batch API
+            process_all_classrooms_batch()
+        elif sys.argv[1] == '--worker':
+            # Run queued background jobs (needs REDIS_URL)
+            run_job_worker()
+        elif sys.argv[1] == '--study-guide' and len(sys.argv) > 2:
+            # Regenerate one study guide, printing it as it is written
+            def print_text(text: str):
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            process_study_guide_only(
+                sys.argv[2],
+                force_regenerate=True,
+                on_text=print_text,
+                on_restart=lambda: print("\n\n[Discarding partial output, regenerating...]\n"),
+            )
+        else:
+            # Process specific classroom
+            classroom_id = sys.argv[1]
+            process_classroom(classroom_id)
+    else:
+        # Process all classrooms
+        print("No classroom ID provided. Processing all classrooms...")
+        process_all_classrooms()
 
 
 if __name__ == '__main__':
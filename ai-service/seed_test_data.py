@@ -9,6 +9,7 @@ Usage: python seed_test_data.py
 """
 
 import os
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -215,25 +216,39 @@ def seed_data(classroom_id: str, user_id: str):
     """Seed test data for a classroom."""
     print(f"Seeding data for classroom {classroom_id}...")
     
-    # Add uploads
-    for upload in SAMPLE_UPLOADS:
-        supabase.table('uploads').insert({
+    # Rows inserted together would share one NOW() timestamp, so give each
+    # its own to keep the sample order
+    now = datetime.now(timezone.utc)
+    
+    def timestamp(i):
+        return (now + timedelta(milliseconds=i)).isoformat()
+    
+    # Add uploads (one request for all of them)
+    supabase.table('uploads').insert([
+        {
             'classroom_id': classroom_id,
             'user_id': user_id,
             'title': upload['title'],
             'content': upload['content'],
-            'file_type': 'text'
-        }).execute()
+            'file_type': 'text',
+            'created_at': timestamp(i)
+        }
+        for i, upload in enumerate(SAMPLE_UPLOADS)
+    ]).execute()
+    for upload in SAMPLE_UPLOADS:
         print(f"  ✓ Added upload: {upload['title']}")
     
-    # Add messages
-    for message in SAMPLE_MESSAGES:
-        supabase.table('messages').insert({
+    # Add messages (one request for all of them)
+    supabase.table('messages').insert([
+        {
             'classroom_id': classroom_id,
             'user_id': user_id,
             'content': message,
-            'channel': 'general'
-        }).execute()
+            'channel': 'general',
+            'created_at': timestamp(i)
+        }
+        for i, message in enumerate(SAMPLE_MESSAGES)
+    ]).execute()
     print(f"  ✓ Added {len(SAMPLE_MESSAGES)} sample messages")
     
     print("\nTest data seeded successfully!")
@@ -66,7 +66,9 @@ CREATE TABLE public.ai_insights (
   unit_name TEXT,
   content TEXT NOT NULL,
   metadata JSONB DEFAULT '{}',
-  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+  created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+  -- One row per insight type (and unit) per classroom; lets the AI service upsert
+  CONSTRAINT ai_insights_classroom_type_unit_key UNIQUE NULLS NOT DISTINCT (classroom_id, insight_type, unit_name)
 );
 
 -- Embeddings for uploads (SIMPLE VERSION - stores as JSONB instead of VECTOR)
@@ -162,12 +164,70 @@ CREATE POLICY "Service can manage embeddings" ON public.upload_embeddings
 -- Create indexes for performance
 CREATE INDEX idx_messages_classroom ON public.messages(classroom_id);
 CREATE INDEX idx_messages_created ON public.messages(created_at);
+CREATE INDEX idx_messages_classroom_created ON public.messages(classroom_id, created_at DESC);
 CREATE INDEX idx_uploads_classroom ON public.uploads(classroom_id);
 CREATE INDEX idx_memberships_user ON public.classroom_memberships(user_id);
 CREATE INDEX idx_memberships_classroom ON public.classroom_memberships(classroom_id);
 CREATE INDEX idx_insights_classroom ON public.ai_insights(classroom_id);
 CREATE INDEX idx_classrooms_join_code ON public.classrooms(join_code);
 
+-- Study guides are long Markdown documents stored out of line (TOAST);
+-- compress them with lz4, which is much faster than the default pglz,
+-- where the server was built with lz4 support
+DO $$
+BEGIN
+  ALTER TABLE public.ai_insights ALTER COLUMN content SET COMPRESSION lz4;
+EXCEPTION WHEN feature_not_supported THEN
+  NULL;
+END $$;
+
+-- Function to stamp regenerated AI insights
+-- The AI service upserts insights without a timestamp and relies on the
+-- database clock; teacher edits (not the service role) and metadata-only
+-- updates (content unchanged) keep the original date.
+CREATE OR REPLACE FUNCTION public.stamp_ai_insight_created_at()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.created_at := NOW();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER ai_insights_stamp_created_at
+  BEFORE UPDATE ON public.ai_insights
+  FOR EACH ROW WHEN (current_user = 'service_role' AND NEW.content IS DISTINCT FROM OLD.content)
+  EXECUTE FUNCTION public.stamp_ai_insight_created_at();
+
+-- Function listing classrooms with activity since their last AI run
+-- Used by the AI service's bulk runs to skip idle classrooms without loading
+-- their notes. A classroom needs a refresh when it has uploads and either has
+-- no study guide, gained or lost uploads since the guide was generated, or
+-- received messages newer than the last one its confusion summary saw.
+CREATE OR REPLACE FUNCTION public.classrooms_needing_ai_refresh()
+RETURNS TABLE (classroom_id UUID) AS $$
+  SELECT c.id
+  FROM public.classrooms c
+  LEFT JOIN public.ai_insights g
+    ON g.classroom_id = c.id AND g.insight_type = 'study_guide' AND g.unit_name = 'Complete Study Guide'
+  LEFT JOIN public.ai_insights s
+    ON s.classroom_id = c.id AND s.insight_type = 'confusion_summary' AND s.unit_name IS NULL
+  WHERE EXISTS (SELECT 1 FROM public.uploads u WHERE u.classroom_id = c.id)
+    AND (
+      g.id IS NULL
+      OR EXISTS (SELECT 1 FROM public.uploads u WHERE u.classroom_id = c.id AND u.created_at > g.created_at)
+      OR (SELECT COUNT(*) FROM public.uploads u WHERE u.classroom_id = c.id)
+         IS DISTINCT FROM (g.metadata->>'upload_count')::BIGINT
+      OR EXISTS (
+        SELECT 1 FROM public.messages m
+        WHERE m.classroom_id = c.id
+          AND m.created_at > COALESCE((s.metadata->>'last_message_at')::TIMESTAMPTZ, s.created_at, '-infinity')
+      )
+    );
+$$ LANGUAGE sql STABLE;
+
+REVOKE EXECUTE ON FUNCTION public.classrooms_needing_ai_refresh() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.classrooms_needing_ai_refresh() TO service_role;
+
 -- Function to generate random join codes
 CREATE OR REPLACE FUNCTION generate_join_code()
 RETURNS TEXT AS $$
@@ -0,0 +1,98 @@
+-- Classly Database Upgrade
+-- Run this in your Supabase SQL Editor if your database was created from an
+-- older version of supabase-schema.sql. Every statement is safe to re-run.
+
+-- ------------------------------------------------------------
+-- Unique AI insights per classroom
+-- The AI service saves study guides and confusion summaries with a single
+-- upsert, which requires this constraint.
+-- ------------------------------------------------------------
+DO $$
+BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_constraint WHERE conname = 'ai_insights_classroom_type_unit_key'
+  ) THEN
+    -- Remove duplicate insights, keeping the most recent row of each kind
+    DELETE FROM public.ai_insights a
+    USING public.ai_insights b
+    WHERE a.classroom_id = b.classroom_id
+      AND a.insight_type = b.insight_type
+      AND a.unit_name IS NOT DISTINCT FROM b.unit_name
+      AND (a.created_at, a.id) < (b.created_at, b.id);
+
+    ALTER TABLE public.ai_insights
+      ADD CONSTRAINT ai_insights_classroom_type_unit_key
+      UNIQUE NULLS NOT DISTINCT (classroom_id, insight_type, unit_name);
+  END IF;
+END $$;
+
+-- ------------------------------------------------------------
+-- Recent-messages index
+-- Confusion analysis reads only the latest messages of one classroom;
+-- this lets Postgres answer that with an index range scan.
+-- ------------------------------------------------------------
+CREATE INDEX IF NOT EXISTS idx_messages_classroom_created
+  ON public.messages(classroom_id, created_at DESC);
+
+-- ------------------------------------------------------------
+-- AI insight timestamps
+-- The AI service no longer sends created_at; the database stamps each
+-- regenerated insight instead. Teacher edits and metadata-only updates
+-- (content unchanged) keep the original date.
+-- ------------------------------------------------------------
+CREATE OR REPLACE FUNCTION public.stamp_ai_insight_created_at()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.created_at := NOW();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS ai_insights_stamp_created_at ON public.ai_insights;
+CREATE TRIGGER ai_insights_stamp_created_at
+  BEFORE UPDATE ON public.ai_insights
+  FOR EACH ROW WHEN (current_user = 'service_role' AND NEW.content IS DISTINCT FROM OLD.content)
+  EXECUTE FUNCTION public.stamp_ai_insight_created_at();
+
+-- ------------------------------------------------------------
+-- Idle classroom detection
+-- Bulk AI runs ask this function which classrooms had new uploads or
+-- messages since their last run, and skip the rest without loading them.
+-- ------------------------------------------------------------
+CREATE OR REPLACE FUNCTION public.classrooms_needing_ai_refresh()
+RETURNS TABLE (classroom_id UUID) AS $$
+  SELECT c.id
+  FROM public.classrooms c
+  LEFT JOIN public.ai_insights g
+    ON g.classroom_id = c.id AND g.insight_type = 'study_guide' AND g.unit_name = 'Complete Study Guide'
+  LEFT JOIN public.ai_insights s
+    ON s.classroom_id = c.id AND s.insight_type = 'confusion_summary' AND s.unit_name IS NULL
+  WHERE EXISTS (SELECT 1 FROM public.uploads u WHERE u.classroom_id = c.id)
+    AND (
+      g.id IS NULL
+      OR EXISTS (SELECT 1 FROM public.uploads u WHERE u.classroom_id = c.id AND u.created_at > g.created_at)
+      OR (SELECT COUNT(*) FROM public.uploads u WHERE u.classroom_id = c.id)
+         IS DISTINCT FROM (g.metadata->>'upload_count')::BIGINT
+      OR EXISTS (
+        SELECT 1 FROM public.messages m
+        WHERE m.classroom_id = c.id
+          AND m.created_at > COALESCE((s.metadata->>'last_message_at')::TIMESTAMPTZ, s.created_at, '-infinity')
+      )
+    );
+$$ LANGUAGE sql STABLE;
+
+REVOKE EXECUTE ON FUNCTION public.classrooms_needing_ai_refresh() FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.classrooms_needing_ai_refresh() TO service_role;
+
+-- ------------------------------------------------------------
+-- Insight content compression
+-- Study guides are long Markdown documents stored out of line (TOAST);
+-- lz4 compresses them much faster than the default pglz. Only applies
+-- to rows written from now on, and is skipped on servers without lz4.
+-- ------------------------------------------------------------
+DO $$
+BEGIN
+  ALTER TABLE public.ai_insights ALTER COLUMN content SET COMPRESSION lz4;
+EXCEPTION WHEN feature_not_supported THEN
+  NULL;
+END $$;